@@ -1,57 +1,112 @@
+import csv
+import io
+import json
 import os
 import sqlite3
-from flask import Flask, flash, redirect, render_template, request, session
-from flask_session import Session
+import threading
+import time
+from flask import Flask, Response, flash, redirect, render_template, request, session, stream_with_context
 from flask import jsonify
 from tempfile import mkdtemp
-from werkzeug.security import check_password_hash, generate_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
 
-from helpers import apology, login_required, lookup, usd
+import db
+import helpers
+import instrumentation
+import metrics
+import passwords
+import sessions
+from helpers import apology, breaker, login_required, lookup, lookup_many, quote_cache, quote_errors, quote_latency, quote_listeners, usd
+from leaderboard import Leaderboard
+from migrations import migrate
+from orderbook import OrderEngine, OrderMatcher
+from performance import PriceRecorder, performance, record_snapshots
+from refresher import QUOTE_REFRESH_INTERVAL, QuoteFeed, QuoteRefresher, QuoteStore
+from trading import SQLITE_MAX_INTEGER, TradeError, execute_basket, execute_trade
 
 
+# Largest share count and limit or stop price (dollars) an order may carry
+ORDER_MAX_SHARES = 1_000_000_000
+ORDER_MAX_PRICE = 1_000_000
+
+# Portfolios shown on the leaderboard
+LEADERBOARD_SIZE = 25
+
+# Transactions shown per history page by default and at most
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 500
+
+# Rows fetched from the database at a time while exporting history
+EXPORT_CHUNK_SIZE = 500
+
+# Seconds between keepalive comments on an idle quote stream
+STREAM_KEEPALIVE = 15
+
+# Quote streams open at once per process, each holding a worker thread; keep this below gunicorn's --threads
+STREAM_MAX_CONNECTIONS = int(os.environ.get('STREAM_MAX_CONNECTIONS', 4))
+
+# Seconds before a quote stream ends, and milliseconds the browser waits before reconnecting
+STREAM_MAX_SECONDS = float(os.environ.get('STREAM_MAX_SECONDS', 60))
+STREAM_RETRY_MS = 3000
+
+# Reverse proxies in front of the app, trusted for the client IP in X-Forwarded-For; 0 (direct clients) uses the socket address
+PROXY_HOPS = int(os.environ.get('PROXY_HOPS', 0))
+
 # Configure application
 app = Flask(__name__)
 
+# Ensure request.remote_addr is the client behind our proxies, not the proxy itself
+if PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS, x_proto=PROXY_HOPS)
+
 # Ensure templates are auto-reloaded
 app.config['TEMPLATES_AUTO_RELOAD'] = True
 
 # Custom filter
 app.jinja_env.filters["usd"] = usd
 
-# Configure session to use filesystem (instead of signed cookies)
+# Configure sessions to use the backend chosen by SESSION_BACKEND (a SQLite table by default)
 app.config['SESSION_PERMANENT'] = False
-app.config['SESSION_TYPE'] = 'filesystem'
-Session(app)
-
-# Connect to database and create a cursor
-conn = sqlite3.connect('database.db', check_same_thread=False)
-c = conn.cursor()
-
-# Create a users table
-c.execute("""CREATE TABLE IF NOT EXISTS users
-           (
-               user_id INTEGER PRIMARY KEY,
-               username TEXT NOT NULL,
-               password_hash TEXT NOT NULL,
-               cash REAL
-           )
-           """)
-conn.commit()
-
-# Create a transactions table
-c.execute("""CREATE TABLE IF NOT EXISTS transactions
-           (
-               transaction_id INTEGER PRIMARY KEY,
-               symbol TEXT NOT NULL,
-               shares REAL NOT NULL,
-               price REAL NOT NULL,
-               timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
-               sum_shares REAL,
-               user_id INTEGER NOT NULL,
-               FOREIGN KEY (user_id) REFERENCES users (user_id)
-           )
-           """)
-conn.commit()
+app.secret_key = os.environ.get('SECRET_KEY')
+sessions.init_app(app)
+
+# Borrow database connections from a pool, one per request
+db.init_app(app)
+
+# Time, count and log every request
+instrumentation.init_app(app)
+
+# Bring the schema up to date
+with db.pool.connection() as conn:
+    migrate(conn)
+
+# Keep price history current whenever fresh quotes arrive, in a background thread
+price_recorder = PriceRecorder()
+price_recorder.start()
+quote_listeners.append(price_recorder.on_quotes)
+
+# Share quotes between worker processes, and keep every held symbol warm in the background
+helpers.shared_store = QuoteStore()
+quote_listeners.append(helpers.shared_store.put_many)
+quote_feed = QuoteFeed()
+quote_listeners.append(quote_feed.publish)
+stream_slots = threading.BoundedSemaphore(STREAM_MAX_CONNECTIONS)
+
+# Fill resting limit and stop orders as fresh quotes cross their trigger prices, in a background thread
+order_engine = OrderEngine()
+with db.pool.connection() as conn:
+    order_engine.sync(conn)
+order_matcher = OrderMatcher(order_engine)
+order_matcher.start()
+quote_listeners.append(order_matcher.on_quotes)
+
+# Keep every user's portfolio value ranked, revaluing holders as fresh quotes arrive
+leaderboard = Leaderboard()
+with db.pool.connection() as conn:
+    leaderboard.rebuild(conn)
+quote_listeners.append(leaderboard.on_quotes)
+if QUOTE_REFRESH_INTERVAL:
+    QuoteRefresher(quote_feed).start()
 
 
 @app.after_request
@@ -76,21 +131,36 @@ def index():
         
         # Get current user id
         user_id = session.get('user_id')
+        c = db.get_db().cursor()
         
         # Get user's cash
-        c.execute("SELECT cash FROM users WHERE user_id = ?", [user_id])
+        c.execute("SELECT cash_cents FROM users WHERE user_id = ?", [user_id])
         cash = c.fetchone()
-        cash = cash[0]
+        cash = cash[0] / 100
         
         # Get user's portfolio
-        c.execute("SELECT symbol, sum_shares FROM transactions WHERE user_id = ? GROUP BY symbol HAVING sum_shares > 0", [user_id])
+        c.execute("SELECT symbol, shares FROM holdings WHERE user_id = ?", [user_id])
         transactions = c.fetchall()
         portfolio_balance = cash
         
-        for transaction in transactions:
-            portfolio_balance += lookup(transaction[0])['price'] * transaction[1]
+        # Resolve every held symbol's quote up front in one batch
+        quotes = lookup_many(transaction[0] for transaction in transactions)
+        holdings = []
+        for symbol, shares in transactions:
+            quote = quotes.get(symbol.upper())
+            holding = {
+                'name': quote['name'] if quote else symbol.upper(),
+                'symbol': symbol.upper(),
+                'shares': shares,
+                'price_value': quote['price'] if quote else '',
+                'price': usd(quote['price']) if quote else '-',
+                'total': usd(quote['price'] * shares) if quote else '-'
+            }
+            if quote:
+                portfolio_balance += quote['price'] * shares
+            holdings.append(holding)
             
-        return render_template('index.html', cash=usd(cash), portfolio_balance=usd(portfolio_balance), transactions=transactions, lookup=lookup, usd=usd)
+        return render_template('index.html', cash=usd(cash), cash_value=cash, portfolio_balance=usd(portfolio_balance), holdings=holdings)
 
                            
                            
@@ -105,7 +175,12 @@ def register():
         if not request.form.get('username'):
             return apology("must provide username", 400)
 
+        # Turn away clients registering too often, before spending anything on them
+        if not passwords.allow_attempt(request.remote_addr):
+            return apology("too many attempts, try again later", 429)
+
         # Query database for username
+        c = db.get_db().cursor()
         c.execute("SELECT * FROM users WHERE username = ?", [request.form.get('username')])
         data = c.fetchall()
         
@@ -122,14 +197,20 @@ def register():
             return apology('password and confirmation do not match')
 
         # Insert new users login credentials into database
-        c.execute("""INSERT INTO users (username, password_hash, cash) VALUES (?,?,10000)""", 
-                   (request.form.get('username'), generate_password_hash(request.form.get('password'))))
-        conn.commit()
+        try:
+            with instrumentation.timed("hashing"):
+                password_hash = passwords.hash_password(request.form.get('password'))
+        except passwords.HashingBusy:
+            return apology("server busy, try again later", 503)
+        try:
+            c.execute("""INSERT INTO users (username, password_hash, cash_cents) VALUES (?,?,1000000)""", 
+                       (request.form.get('username'), password_hash))
+        except sqlite3.IntegrityError:
+            return apology('username already taken', 400)
         
         # Remember which user has logged in
         c.execute("SELECT user_id FROM users WHERE username = ?", [request.form.get("username")])
         user_id = c.fetchone()
-        print(user_id[0])
         session['user_id'] = user_id[0]
         
         # Confirm registration
@@ -158,12 +239,27 @@ def login():
         elif not request.form.get('password'):
             return apology("must provide password", 400)
 
+        # Turn away clients and usernames seeing too many attempts, before any hashing
+        if not passwords.allow_attempt(request.remote_addr, request.form.get('username')):
+            return apology("too many login attempts, try again later", 429)
+
         # Query database for username
+        c = db.get_db().cursor()
         c.execute("SELECT * FROM users WHERE username = ?", [request.form.get('username')])
         data = c.fetchall()
 
         # Ensure username exists and password is correct
-        if len(data) != 1 or not check_password_hash(data[0][2], request.form.get('password')):
+        try:
+            with instrumentation.timed("hashing"):
+                valid = len(data) == 1 and passwords.check_password(data[0][2], request.form.get('password'))
+                
+                # Upgrade a hash made with an older method or cost while we have the password
+                if valid and passwords.needs_rehash(data[0][2]):
+                    c.execute("UPDATE users SET password_hash = ? WHERE user_id = ?",
+                              (passwords.hash_password(request.form.get('password')), data[0][0]))
+        except passwords.HashingBusy:
+            return apology("server busy, try again later", 503)
+        if not valid:
             return apology("invalid username and/or password", 400)
 
         # Remember which user has logged in
@@ -233,7 +329,7 @@ def buy():
         if not request.form.get('symbol'):
             return apology('no stock entered', 403)
         else:
-            symbol = request.form.get('symbol')
+            symbol = request.form.get('symbol').upper()
 
         # Ensure number of shares is an integer or float
         shares = request.form.get('shares')
@@ -252,31 +348,11 @@ def buy():
         # If lookup succesfull
         price = quote['price']
 
-        # Lookup how much cash the user has
-        c.execute("SELECT cash FROM users WHERE user_id = ?", [user_id])
-        cash = c.fetchone()
-
-        # Ensure user has enough cash to purchase required shares
-        value = float(shares) * float(price)
-        if value > cash[0]:
-            return apology('not enough cash')
-
-        # Purchase shares
-        cash = cash[0] - value
-        c.execute("UPDATE users SET cash = ? WHERE user_id = ?", (cash, user_id))
-        conn.commit()
-        c.execute("SELECT sum_shares FROM transactions WHERE symbol = ? AND user_id = ?", (symbol, user_id))
-        sum_shares = c.fetchone()
-        if not sum_shares:
-            sum_shares = 0
-            sum_shares = float(sum_shares) + float(shares)
-        else:
-            sum_shares = sum_shares[0] + float(shares)
-        c.execute("INSERT INTO transactions (user_id, symbol, shares, price) VALUES (?,?,?,?)", 
-                  (user_id, symbol, shares, price))
-        conn.commit()
-        c.execute("UPDATE transactions SET sum_shares = ? WHERE user_id = ? AND symbol = ?", (sum_shares, user_id, symbol))
-        conn.commit()
+        # Purchase shares, ensuring user has enough cash in the same transaction
+        try:
+            execute_trade(db.get_db(), user_id, symbol, float(shares), price)
+        except TradeError as e:
+            return apology(str(e))
         
         return redirect('/history')
 
@@ -292,6 +368,7 @@ def sell():
     
     # Get current user id
     user_id = session.get("user_id")
+    c = db.get_db().cursor()
     
     # User reached route via POST (as by submitting a form via POST)
     if request.method == "POST":
@@ -299,11 +376,11 @@ def sell():
         # Ensure stock symbol was submitted
         if not request.form.get("symbol"):
             return apology("must provide stock symbol", 403)
-        else: symbol = request.form.get("symbol")
+        else: symbol = request.form.get("symbol").upper()
 
-        # Ensure number of shares is a positive integer
-        shares = request.form.get("shares")
-        if float(shares) < 0:
+        # Ensure number of shares is a whole, positive number
+        shares = request.form.get("shares", "")
+        if not shares.isdecimal() or int(shares) <= 0:
             return apology("number of shares invalid")
 
         # Look up a stocks current price
@@ -316,35 +393,11 @@ def sell():
         # If lookup succesfull
         price = quote["price"]
 
-        # Value of sale
-        sale_value = float(shares) * float(price)
-
-        # Lookup how many units of stock the user has
-        c.execute("SELECT SUM(shares) FROM transactions WHERE user_id = ? AND symbol = ?", (user_id, symbol))
-        symbol_balance = c.fetchone()
-
-        # Ensure user has enough units of stock to sell
-        if float(shares) > symbol_balance[0]:
-            return apology("not enough stock")
-
-        # Lookup how much cash the user has
-        c.execute("SELECT cash FROM users WHERE user_id = ?", [user_id])
-        cash = c.fetchone()
-
-        # Sell shares
-        sell_shares = 0 - float(shares)
-        cash = cash[0] + sale_value
-        c.execute("UPDATE users SET cash = ? WHERE user_id = ?", (cash, user_id))
-        conn.commit()
-        c.execute("SELECT SUM(shares) FROM transactions WHERE user_id = ? AND symbol = ?", (user_id, symbol))
-        sum_shares = c.fetchone()
-        sum_shares = sum_shares[0] + sell_shares
-        symbol_balance = symbol_balance[0] - float(shares)
-        c.execute("INSERT INTO transactions (user_id, symbol, shares, price) VALUES (?,?,?,?)", 
-                  (user_id, symbol, sell_shares, price))
-        conn.commit()
-        c.execute("UPDATE transactions SET sum_shares = ? WHERE user_id = ? AND symbol = ?", (sum_shares, user_id, symbol))
-        conn.commit()
+        # Sell shares, ensuring user has enough units of stock in the same transaction
+        try:
+            execute_trade(db.get_db(), user_id, symbol, -int(shares), price)
+        except TradeError as e:
+            return apology(str(e))
 
         # User reached route via GET (as by clicking a link or via redirect
         return redirect("/history")
@@ -352,11 +405,124 @@ def sell():
     # User reached route via GET (as by clicking a link or via redirect)
     else:
         # Lookup how many units of stock the user has
-        c.execute("SELECT DISTINCT symbol FROM transactions WHERE user_id = ?", [user_id])
+        c.execute("SELECT symbol FROM holdings WHERE user_id = ?", [user_id])
         transactions = c.fetchall()
         return render_template("sell.html", transactions=transactions)
     
     
+@app.route("/api/orders", methods=["POST"])
+@login_required
+def orders():
+    """Buy and sell a basket of stocks in one request"""
+    
+    # Get current user id
+    user_id = session.get('user_id')
+    
+    # Ensure the body holds a list of orders
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('orders'), list) or not data['orders']:
+        return jsonify(error='body must be {"orders": [{"symbol", "side", "shares"}, ...]}'), 400
+    
+    # Ensure every order names a symbol, a side and a whole, positive number of shares, as /buy and /sell do
+    basket = []
+    for order in data['orders']:
+        if not isinstance(order, dict) or not isinstance(order.get('symbol'), str) or not order['symbol']:
+            return jsonify(error='every order must provide a stock symbol'), 400
+        if order.get('side') not in ('buy', 'sell'):
+            return jsonify(error='side must be "buy" or "sell"'), 400
+        shares = order.get('shares')
+        if isinstance(shares, bool) or not isinstance(shares, int) or not 0 < shares <= SQLITE_MAX_INTEGER:
+            return jsonify(error='number of shares invalid'), 400
+        basket.append({'symbol': order['symbol'], 'shares': shares if order['side'] == 'buy' else -shares})
+    
+    # Price every symbol in one batch, then apply the basket in one transaction
+    quotes = lookup_many(order['symbol'] for order in basket)
+    results = execute_basket(db.get_db(), user_id, basket, quotes)
+    for result, order in zip(results, data['orders']):
+        result['side'] = order['side']
+        result['shares'] = abs(result['shares'])
+    
+    c = db.get_db().cursor()
+    c.execute("SELECT cash_cents FROM users WHERE user_id = ?", [user_id])
+    return jsonify(results=results, cash=c.fetchone()[0] / 100)
+    
+    
+@app.route("/orders", methods=["GET", "POST"])
+@login_required
+def limit_orders():
+    """Place limit and stop orders and list the user's orders"""
+    
+    # Get current user id
+    user_id = session.get('user_id')
+    c = db.get_db().cursor()
+    
+    # User reached route via POST (as by submitting a form via POST)
+    if request.method == 'POST':
+        
+        # Ensure stock symbol was submitted
+        if not request.form.get('symbol'):
+            return apology('no stock entered', 403)
+        symbol = request.form.get('symbol').upper()
+        
+        # Ensure side and order type are known
+        side = request.form.get('side')
+        kind = request.form.get('kind')
+        if side not in ('buy', 'sell') or kind not in ('limit', 'stop'):
+            return apology('order side or type invalid', 400)
+        
+        # Ensure number of shares is a positive integer within bounds
+        shares = request.form.get('shares', '')
+        if not shares.isdecimal() or not 0 < int(shares) <= ORDER_MAX_SHARES:
+            return apology('number of shares invalid', 400)
+        
+        # Ensure trigger price is a positive, finite amount within bounds
+        try:
+            trigger_cents = round(float(request.form.get('price', '')) * 100)
+        except (ValueError, OverflowError):
+            return apology('price must be numerical', 400)
+        if not 0 < trigger_cents <= ORDER_MAX_PRICE * 100:
+            return apology(f'price must be between $0.01 and {usd(ORDER_MAX_PRICE)}', 400)
+        
+        # Ensure stock symbol is valid
+        quote = lookup(symbol)
+        if not quote:
+            return apology('stock not found', 400)
+        
+        # Rest the order, filling it straight away if the current price already crosses it
+        order_engine.place(db.get_db(), user_id, symbol, side, kind, int(shares), trigger_cents, round(quote['price'] * 100))
+        return redirect('/orders')
+    
+    # Get the user's orders, newest first
+    c.execute("""SELECT order_id, symbol, side, kind, shares, trigger_cents, status, created_at, fill_price_cents, error
+                 FROM orders WHERE user_id = ? ORDER BY order_id DESC LIMIT ?""", (user_id, HISTORY_PAGE_SIZE))
+    rows = []
+    for order_id, symbol, side, kind, shares, trigger_cents, status, created_at, fill_price_cents, error in c.fetchall():
+        rows.append({
+            'order_id': order_id,
+            'symbol': symbol,
+            'side': side,
+            'kind': kind,
+            'shares': shares,
+            'price': usd(trigger_cents / 100),
+            'status': status,
+            'created_at': created_at,
+            'fill_price': usd(fill_price_cents / 100) if fill_price_cents is not None else (error or '-')
+        })
+    return render_template('orders.html', orders=rows)
+
+
+@app.route("/orders/cancel", methods=["POST"])
+@login_required
+def cancel_order():
+    """Cancel one of the user's open orders"""
+    
+    # Ensure the order is the user's and still open
+    order_id = request.form.get('order_id', type=int)
+    if order_id is None or not order_engine.cancel(db.get_db(), session.get('user_id'), order_id):
+        return apology('order not found or no longer open', 400)
+    return redirect('/orders')
+    
+    
 @app.route("/deposit", methods=["GET", "POST"])
 @login_required
 def deposit():
@@ -364,6 +530,7 @@ def deposit():
     
     # Get current user id
     user_id = session.get('user_id')
+    c = db.get_db().cursor()
 
     # User reached route via POST (as by submitting a form via POST)
     if request.method == "POST":
@@ -379,13 +546,14 @@ def deposit():
         if float(request.form.get("deposit_amount")) > 50000:
             return apology("max deposit $50,000")
 
-        # If successfull deposit, update user funds
-        c.execute("SELECT cash FROM users WHERE user_id = ?", [user_id])
-        user_cash = c.fetchone()
-        deposit = (request.form.get("deposit_amount"))
-        user_cash = float(user_cash[0]) + float(deposit)
-        c.execute("UPDATE users SET cash = ? WHERE user_id = ?", (user_cash, user_id))
-        conn.commit()
+        # If successfull deposit, update user funds and today's portfolio snapshot
+        deposit = round(float(request.form.get("deposit_amount")) * 100)
+        with db.transaction(db.get_db()):
+            c.execute("UPDATE users SET cash_cents = cash_cents + ? WHERE user_id = ?", (deposit, user_id))
+            record_snapshots(db.get_db(), [user_id])
+        
+        # Deposits leave no ledger entry, so update the user's leaderboard value directly
+        leaderboard.refresh(db.get_db(), [user_id])
         return redirect("/buy")
 
     # User reached route via GET (as by clicking a link or via redirect)
@@ -402,6 +570,193 @@ def history():
     
     # Get current user id
     user_id = session.get('user_id')
-    c.execute("SELECT * FROM transactions WHERE user_id = ?", [user_id])
+    c = db.get_db().cursor()
+    
+    # Ensure page size and cursor are valid
+    limit = request.args.get('limit', HISTORY_PAGE_SIZE, type=int)
+    before = request.args.get('before', type=int)
+    if limit is None or not 1 <= limit <= HISTORY_MAX_PAGE_SIZE:
+        return apology(f'page size must be between 1 and {HISTORY_MAX_PAGE_SIZE}')
+    
+    # Get one page of transactions, newest first, starting below the cursor
+    if before is None:
+        c.execute("""SELECT transaction_id, symbol, shares, price_cents, timestamp FROM transactions
+                     WHERE user_id = ? ORDER BY transaction_id DESC LIMIT ?""", (user_id, limit + 1))
+    else:
+        c.execute("""SELECT transaction_id, symbol, shares, price_cents, timestamp FROM transactions
+                     WHERE user_id = ? AND transaction_id < ? ORDER BY transaction_id DESC LIMIT ?""", (user_id, before, limit + 1))
     transactions = c.fetchall()
-    return render_template('history.html', transactions=transactions, lookup=lookup, usd=usd)
\ No newline at end of file
+    
+    # The extra row only tells us whether an older page exists
+    next_before = None
+    if len(transactions) > limit:
+        transactions = transactions[:limit]
+        next_before = transactions[-1][0]
+    
+    # Resolve company names for every distinct symbol in one batch
+    quotes = lookup_many(transaction[1] for transaction in transactions)
+    rows = []
+    for transaction in transactions:
+        quote = quotes.get(transaction[1].upper())
+        rows.append({
+            'transaction_id': transaction[0],
+            'name': quote['name'] if quote else transaction[1].upper(),
+            'symbol': transaction[1].upper(),
+            'shares': transaction[2],
+            'price': usd(transaction[3] / 100),
+            'timestamp': transaction[4]
+        })
+    return render_template('history.html', transactions=rows, limit=limit, before=before, next_before=next_before)
+
+
+@app.route("/history/export")
+@login_required
+def history_export():
+    """Download full transaction history as CSV or JSON"""
+    
+    # Get current user id
+    user_id = session.get('user_id')
+    
+    # Ensure export format is supported
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'json'):
+        return apology('format must be csv or json')
+    
+    columns = ['transaction_id', 'symbol', 'shares', 'price', 'timestamp']
+    
+    def rows():
+        """Yield the user's transactions a chunk at a time from a server-side cursor."""
+        c = db.get_db().cursor()
+        c.execute("""SELECT transaction_id, symbol, shares, price_cents / 100.0, timestamp FROM transactions
+                     WHERE user_id = ? ORDER BY transaction_id""", [user_id])
+        while True:
+            chunk = c.fetchmany(EXPORT_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield from chunk
+    
+    def generate_csv():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for row in rows():
+            writer.writerow(row)
+            if buffer.tell() > 65536:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    
+    def generate_json():
+        yield '['
+        for i, row in enumerate(rows()):
+            yield (',' if i else '') + json.dumps(dict(zip(columns, row)))
+        yield ']'
+    
+    if export_format == 'csv':
+        response = Response(stream_with_context(generate_csv()), mimetype='text/csv')
+    else:
+        response = Response(stream_with_context(generate_json()), mimetype='application/json')
+    response.headers['Content-Disposition'] = f'attachment; filename=history.{export_format}'
+    return response
+
+
+@app.route("/performance")
+@login_required
+def portfolio_performance():
+    """Show portfolio value over time and gains per stock"""
+    
+    # Get current user id
+    user_id = session.get('user_id')
+    
+    # Load the precomputed daily series
+    report = performance(db.get_db(), user_id)
+    
+    # Scale the equity curve into the chart's 600x200 box
+    equity = [day['equity'] for day in report['series']]
+    points = ''
+    if len(equity) > 1:
+        low, high = min(equity), max(equity)
+        span = (high - low) or 1
+        points = ' '.join(f"{600 * i / (len(equity) - 1):.1f},{200 - 200 * (value - low) / span:.1f}"
+                          for i, value in enumerate(equity))
+    
+    return render_template('performance.html', series=report['series'][::-1], gains=report['gains'], points=points)
+
+
+@app.route("/api/performance")
+@login_required
+def api_performance():
+    """Return portfolio value over time and gains per stock as JSON"""
+    return jsonify(performance(db.get_db(), session.get('user_id')))
+
+
+@app.route("/leaderboard")
+@login_required
+def leaderboard_page():
+    """Rank every user by portfolio value"""
+    
+    # Catch up on trades, new users and quotes from every worker before reading
+    leaderboard.sync(db.get_db())
+    
+    # Get the top portfolios and the current user's place among them
+    top = leaderboard.top(LEADERBOARD_SIZE)
+    mine = leaderboard.rank(session.get('user_id'))
+    for entry in top + ([mine] if mine else []):
+        entry['value'] = usd(entry['value_cents'] / 100)
+    return render_template('leaderboard.html', top=top, mine=mine, total=len(leaderboard))
+
+
+@app.route("/stream/quotes")
+@login_required
+def stream_quotes():
+    """Push price updates for the user's holdings as Server-Sent Events"""
+    
+    # Get the symbols in the user's portfolio
+    user_id = session.get('user_id')
+    c = db.get_db().cursor()
+    c.execute("SELECT symbol FROM holdings WHERE user_id = ?", [user_id])
+    symbols = {row[0] for row in c.fetchall()}
+    
+    # Ensure streams leave worker threads free for other routes; 204 tells the browser not to reconnect
+    if not stream_slots.acquire(blocking=False):
+        return Response(status=204)
+    
+    def events():
+        """Yield the latest prices now and after every feed update, with keepalives while idle, until the stream times out."""
+        yield f'retry: {STREAM_RETRY_MS}\n\n'
+        deadline = time.monotonic() + STREAM_MAX_SECONDS
+        version = None
+        sent = None
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            latest_version, latest = quote_feed.wait(version, min(STREAM_KEEPALIVE, remaining))
+            if latest_version == version:
+                yield ': keepalive\n\n'
+                continue
+            version = latest_version
+            prices = {symbol: latest[symbol]['price'] for symbol in symbols if symbol in latest}
+            if prices and prices != sent:
+                sent = prices
+                yield f'data: {json.dumps(prices)}\n\n'
+    
+    # The request's pooled connection is released before streaming starts; the slot once the stream closes
+    response = Response(events(), mimetype='text/event-stream')
+    response.call_on_close(stream_slots.release)
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route("/status")
+def status():
+    """Report connection pool, quote cache and quote provider health"""
+    return jsonify(db_pool=db.pool.stats(), quote_cache=quote_cache.stats(), quote_breaker=breaker.state,
+                   quote_latency=quote_latency.stats(), quote_errors=quote_errors.stats())
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Expose every metric in the Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
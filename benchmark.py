@@ -0,0 +1,462 @@
+"""Load-test the app's main routes against a seeded scratch database.
+
+Seeds a fresh database with --users users and --transactions trades, swaps the
+quote API for the local simulated provider, then drives /, /history, /buy,
+/sell and /login concurrently and reports latency percentiles, throughput and
+SQL statements per request for each route.
+
+    python benchmark.py --users 1000 --transactions 100000 --requests 500
+    python benchmark.py --mode gunicorn --workers 4 --threads 8
+    python benchmark.py --mode structures --orders 50000
+
+In client mode requests go through Flask's test client inside this process.
+In gunicorn mode they go over HTTP to a gunicorn server started on the seeded
+database. SQL counts aren't visible from outside the server in that mode, and
+each thread logs in once per user it meets, which counts against throughput
+(but not latency), so use fewer users there.
+
+Structures mode drives the quote circuit breaker, the in-memory order book,
+the leaderboard and performance reports directly instead of routes. Each
+result is checked against a brute-force scan, or against values recomputed
+from the seeded database, and each operation is timed. It exits with an
+AssertionError on the first mismatch.
+"""
+
+import argparse
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+ROUTES = ["/", "/history", "/buy", "/sell", "/login"]
+SYMBOLS = ["AAPL", "MSFT", "NVDA", "TSLA", "NFLX", "AMZN", "GOOG", "META", "MSTR", "AMD"]
+PASSWORD = "password"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=100, help="users to seed")
+    parser.add_argument("--transactions", type=int, default=10000, help="trades to seed, spread across users")
+    parser.add_argument("--requests", type=int, default=200, help="requests per route")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent client threads")
+    parser.add_argument("--routes", nargs="+", default=ROUTES, choices=ROUTES, help="routes to drive")
+    parser.add_argument("--mode", choices=["client", "gunicorn", "structures"], default="client")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn worker processes")
+    parser.add_argument("--threads", type=int, default=8, help="gunicorn threads per worker")
+    parser.add_argument("--port", type=int, default=8765, help="gunicorn port")
+    parser.add_argument("--orders", type=int, default=20000, help="open orders in structures mode")
+    parser.add_argument("--database", help="database file to seed (default: a new temporary file)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for data and requests")
+    return parser.parse_args()
+
+
+def configure(args):
+    """Point the app at the benchmark database and the local simulated quote provider."""
+    if not args.database:
+        args.database = os.path.join(tempfile.mkdtemp(prefix="mockstock-bench-"), "bench.db")
+    os.environ.update({
+        "DATABASE": args.database,
+        "QUOTE_PROVIDER": "simulated",
+        "QUOTE_SEED": str(args.seed),
+        "QUOTE_REFRESH_INTERVAL": "0",
+        "SESSION_BACKEND": "sqlite",
+        "REQUEST_LOG": "0",
+        "LOGIN_IP_RATE": "0",
+        "LOGIN_USER_RATE": "0",
+    })
+
+
+def seed(args):
+    """Create the schema and fill it with users, buy trades and matching holdings."""
+    import sqlite3
+    from werkzeug.security import generate_password_hash
+
+    from migrations import migrate
+    from passwords import PASSWORD_HASH_METHOD
+
+    if os.path.exists(args.database):
+        os.remove(args.database)
+    conn = sqlite3.connect(args.database, isolation_level=None)
+    migrate(conn)
+
+    # Every user shares one password hash, so seeding doesn't spend minutes hashing
+    rng = random.Random(args.seed)
+    password_hash = generate_password_hash(PASSWORD, PASSWORD_HASH_METHOD)
+    conn.execute("BEGIN")
+    conn.executemany("INSERT INTO users (user_id, username, password_hash, cash_cents) VALUES (?,?,?,?)",
+                     [(user_id, f"user{user_id}", password_hash, 10_000_000_00) for user_id in range(1, args.users + 1)])
+    conn.executemany("INSERT INTO transactions (user_id, symbol, shares, price_cents, timestamp) VALUES (?,?,?,?,datetime('now', ?))",
+                     [(rng.randint(1, args.users), rng.choice(SYMBOLS), rng.randint(1, 20), rng.randint(1000, 50000),
+                       f"-{rng.randint(0, 365)} days")
+                      for _ in range(args.transactions)])
+    conn.execute("""INSERT INTO holdings (user_id, symbol, shares, cost_basis_cents)
+                    SELECT user_id, symbol, SUM(shares), SUM(shares * price_cents) FROM transactions GROUP BY user_id, symbol""")
+    conn.execute("COMMIT")
+    conn.close()
+
+
+class Results:
+    """Latencies, failures and SQL statement counts collected per route."""
+
+    def __init__(self):
+        self.latencies = {route: [] for route in ROUTES}
+        self.failures = {route: 0 for route in ROUTES}
+        self.statements = {route: None for route in ROUTES}
+        self.elapsed = {route: 0.0 for route in ROUTES}
+        self._lock = threading.Lock()
+
+    def record(self, route, seconds, ok, statements=None):
+        with self._lock:
+            self.latencies[route].append(seconds)
+            if statements is not None:
+                self.statements[route] = (self.statements[route] or 0) + statements
+            if not ok:
+                self.failures[route] += 1
+
+    def report(self, routes):
+        print(f"{'route':<10}{'requests':>9}{'failed':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'req/s':>9}{'sql/req':>9}")
+        for route in routes:
+            latencies = sorted(self.latencies[route])
+            if not latencies:
+                continue
+            cuts = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else latencies * 99
+            print(f"{route:<10}{len(latencies):>9}{self.failures[route]:>8}"
+                  f"{cuts[49] * 1000:>9.2f}{cuts[94] * 1000:>9.2f}{cuts[98] * 1000:>9.2f}"
+                  f"{len(latencies) / self.elapsed[route]:>9.1f}"
+                  + (f"{self.statements[route] / len(latencies):>9.1f}" if self.statements[route] is not None else f"{'-':>9}"))
+
+
+def request_for(route, rng, users):
+    """Return (method, path, form data, user_id) for one randomized request to route."""
+    user_id = rng.randint(1, users)
+    if route == "/buy":
+        return "POST", route, {"symbol": rng.choice(SYMBOLS), "shares": "1"}, user_id
+    if route == "/sell":
+        return "POST", route, {"symbol": rng.choice(SYMBOLS), "shares": "1"}, user_id
+    if route == "/login":
+        return "POST", route, {"username": f"user{user_id}", "password": PASSWORD}, None
+    return "GET", route, None, user_id
+
+
+def run_client(args, results):
+    """Drive routes through Flask's test client, counting SQL statements per request."""
+    import app
+    import db
+
+    counts = threading.local()
+
+    def count_statement(statement):
+        counts.value = getattr(counts, "value", 0) + 1
+
+    db.statement_listeners.append(count_statement)
+    clients = threading.local()
+
+    def client_for(user_id):
+        """Return this thread's test client, logged in as user_id."""
+        if not hasattr(clients, "value"):
+            clients.value = app.app.test_client()
+        client = clients.value
+        if user_id is not None:
+            with client.session_transaction() as session:
+                session["user_id"] = user_id
+        return client
+
+    def one(route, rng):
+        method, path, data, user_id = request_for(route, rng, args.users)
+        client = client_for(user_id)
+        counts.value = 0
+        start = time.perf_counter()
+        response = client.open(path, method=method, data=data)
+        seconds = time.perf_counter() - start
+        results.record(route, seconds, response.status_code < 400, counts.value)
+
+    drive(args, results, one)
+
+
+def run_gunicorn(args, results):
+    """Drive routes over HTTP against a gunicorn server running the app on the seeded database."""
+    import requests
+
+    base = f"http://127.0.0.1:{args.port}"
+    server = subprocess.Popen([sys.executable, "-m", "gunicorn", "--workers", str(args.workers),
+                               "--worker-class", "gthread", "--threads", str(args.threads),
+                               "--bind", f"127.0.0.1:{args.port}", "--log-level", "warning", "app:app"],
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+    try:
+
+        # Wait for the server to accept connections
+        for _ in range(100):
+            try:
+                requests.get(base + "/login", timeout=5)
+                break
+            except requests.RequestException:
+                time.sleep(0.1)
+        else:
+            raise RuntimeError("gunicorn did not start")
+
+        sessions = threading.local()
+
+        def session_for(user_id):
+            """Return this thread's HTTP session for user_id, logging in the first time."""
+            if not hasattr(sessions, "value"):
+                sessions.value = {}
+            if user_id not in sessions.value:
+                session = sessions.value[user_id] = requests.Session()
+                if user_id is not None:
+                    session.post(base + "/login", data={"username": f"user{user_id}", "password": PASSWORD})
+            return sessions.value[user_id]
+
+        def one(route, rng):
+            method, path, data, user_id = request_for(route, rng, args.users)
+            session = session_for(user_id)
+            start = time.perf_counter()
+            response = session.request(method, base + path, data=data, allow_redirects=False)
+            results.record(route, time.perf_counter() - start, response.status_code < 400)
+
+        drive(args, results, one)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def timing(name, seconds):
+    """Print the p50/p99 and max of a list of operation times in microseconds."""
+    seconds = sorted(seconds)
+    cuts = statistics.quantiles(seconds, n=100, method="inclusive") if len(seconds) > 1 else seconds * 99
+    print(f"{name:<28}{len(seconds):>9}{cuts[49] * 1e6:>10.1f}{cuts[98] * 1e6:>10.1f}{seconds[-1] * 1e6:>10.1f}")
+
+
+def check_circuit_breaker():
+    """Walk a CircuitBreaker through closed, open, half-open and back, asserting each transition."""
+    from quotes import CircuitBreaker
+
+    breaker = CircuitBreaker(threshold=3, reset_timeout=0.05)
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.failure()
+    assert breaker.state == "closed"
+    breaker.failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+    # After the timeout exactly one trial call goes through, and its failure reopens the breaker
+    time.sleep(0.06)
+    assert breaker.state == "half-open" and breaker.allow() and not breaker.allow()
+    breaker.failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+    # A successful trial closes it again
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == "closed" and breaker.allow() and breaker.failures == 0
+    print("circuit breaker: closed, open, half-open and reset transitions all hold")
+
+
+def check_order_book(args):
+    """Check OrderBook.crossed against a scan of every open order while prices random-walk, timing each check."""
+    from orderbook import OrderBook, crosses
+
+    rng = random.Random(args.seed)
+    prices = {symbol: 10000 for symbol in SYMBOLS}
+    book = OrderBook()
+    open_orders = {}
+
+    def place(order_id):
+        symbol = rng.choice(SYMBOLS)
+        offset = rng.randint(1, 2000)
+        order = {"order_id": order_id, "user_id": 1, "symbol": symbol, "side": rng.choice(["buy", "sell"]),
+                 "kind": rng.choice(["limit", "stop"]), "shares": 1, "trigger_cents": prices[symbol] + offset}
+
+        # Rest orders on the far side of the market, as an order that would fill at once never reaches the book
+        if crosses(order, prices[symbol]):
+            order["trigger_cents"] = max(1, prices[symbol] - offset)
+        book.add(order)
+        open_orders[order_id] = order
+
+    # Fill the book, and cancel a third of it so lazy deletion and compaction are exercised
+    for order_id in range(1, args.orders + 1):
+        place(order_id)
+    for order_id in rng.sample(sorted(open_orders), args.orders // 3):
+        assert book.remove(order_id) is open_orders.pop(order_id)
+    next_id = args.orders + 1
+
+    seconds = []
+    fired = 0
+    for _ in range(args.requests * 10):
+        symbol = rng.choice(SYMBOLS)
+        prices[symbol] = max(1, prices[symbol] + rng.randint(-50, 50))
+        start = time.perf_counter()
+        crossed = book.crossed(symbol, prices[symbol])
+        seconds.append(time.perf_counter() - start)
+
+        expected = sorted(order_id for order_id, order in open_orders.items()
+                          if order["symbol"] == symbol and crosses(order, prices[symbol]))
+        assert [order["order_id"] for order in crossed] == expected, f"{symbol} at {prices[symbol]}"
+        for order_id in expected:
+            del open_orders[order_id]
+        fired += len(expected)
+
+        # Keep the book topped up with fresh orders
+        while len(open_orders) < args.orders * 2 // 3:
+            place(next_id)
+            next_id += 1
+    assert len(book) == len(open_orders)
+    timing("OrderBook.crossed()", seconds)
+    print(f"  {len(open_orders)} open orders, {fired} fired, every match agrees with a full scan")
+
+
+def check_leaderboard(args):
+    """Check Leaderboard ranks against values recomputed from the database as prices move, trades land and it rebuilds."""
+    import db
+    from leaderboard import Leaderboard
+    from performance import record_prices
+    from trading import TradeError, execute_trade
+
+    rng = random.Random(args.seed)
+    prices = {}
+    board = Leaderboard(rebuild_interval=float("inf"))
+
+    def verify(conn):
+        """Assert every user's value and rank, and the top 25, match a recomputation from scratch."""
+        values = dict(conn.execute("SELECT user_id, cash_cents FROM users").fetchall())
+        for user_id, symbol, shares, cost_basis_cents in conn.execute("SELECT user_id, symbol, shares, cost_basis_cents FROM holdings"):
+            values[user_id] += round(shares * prices[symbol]) if symbol in prices else cost_basis_cents
+        ordered = sorted(values.values(), reverse=True)
+        ranks = {}
+        for i, value in enumerate(ordered, start=1):
+            ranks.setdefault(value, i)
+        for user_id, value in values.items():
+            entry = board.rank(user_id)
+            assert (entry["value_cents"], entry["rank"]) == (value, ranks[value]), f"user {user_id}"
+        assert [entry["value_cents"] for entry in board.top(25)] == ordered[:25]
+
+    moves, syncs, ranks, tops = [], [], [], []
+    with db.pool.connection() as conn:
+        start = time.perf_counter()
+        board.rebuild(conn)
+        rebuild = time.perf_counter() - start
+        verify(conn)
+        for step in range(1, args.requests + 1):
+
+            # Move a price, as a fresh quote would
+            symbol = rng.choice(SYMBOLS)
+            prices[symbol] = rng.randint(1000, 50000)
+            start = time.perf_counter()
+            board.update_prices({symbol: prices[symbol]})
+            moves.append(time.perf_counter() - start)
+
+            # Land a trade or a deposit (as another worker would), then catch up the way a leaderboard read does
+            user_id = rng.randint(1, args.users)
+            if step % 10 == 0:
+                conn.execute("UPDATE users SET cash_cents = cash_cents + 10000 WHERE user_id = ?", (user_id,))
+            else:
+                try:
+                    execute_trade(conn, user_id, symbol, rng.choice([1, -1]) * rng.randint(1, 5), prices[symbol] / 100)
+                except TradeError:
+                    pass
+            start = time.perf_counter()
+            board.sync(conn)
+            syncs.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            board.rank(rng.randint(1, args.users))
+            ranks.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            board.top(25)
+            tops.append(time.perf_counter() - start)
+            if step % 20 == 0:
+                verify(conn)
+
+            # Halfway, store the prices moved so far as the app's quote listeners would, then let a sync
+            # start the periodic rebuild and keep moving prices while it runs
+            if step == args.requests // 2:
+                with db.transaction(conn):
+                    record_prices(conn, prices, [])
+                board.rebuild_interval = 0
+                board.sync(conn)
+                board.rebuild_interval = float("inf")
+                while board._rebuilding is not None or any(thread.name == "leaderboard-rebuild" for thread in threading.enumerate()):
+                    symbol = rng.choice(SYMBOLS)
+                    prices[symbol] = rng.randint(1000, 50000)
+                    board.update_prices({symbol: prices[symbol]})
+                verify(conn)
+        verify(conn)
+    timing("Leaderboard.rebuild()", [rebuild])
+    timing("Leaderboard.update_prices()", moves)
+    timing("Leaderboard.sync()", syncs)
+    timing("Leaderboard.rank()", ranks)
+    timing("Leaderboard.top(25)", tops)
+    print(f"  {len(board)} users, every value and rank agrees with a recomputation from the database")
+
+
+def check_performance(args):
+    """Check performance reports for a user whose symbols have no prices yet and one who has sold out."""
+    import db
+    from performance import performance
+    from trading import execute_trade
+
+    with db.pool.connection() as conn:
+        # Seeded users hold symbols with no stored price, so positions are marked at cost
+        user_id = conn.execute("SELECT MIN(user_id) FROM holdings").fetchone()[0]
+        conn.execute("DELETE FROM prices")
+        report = performance(conn, user_id)
+        assert report["series"] and report["gains"], "no prices"
+        assert all(gain["market_value"] == gain["cost_basis"] for gain in report["gains"]), "no prices"
+
+        # A user who sold everything only has realized gains left
+        conn.execute("INSERT INTO users (username, password_hash, cash_cents) VALUES ('soldout', '', 100000)")
+        user_id = conn.execute("SELECT user_id FROM users WHERE username = 'soldout'").fetchone()[0]
+        execute_trade(conn, user_id, "AAPL", 3, 100)
+        execute_trade(conn, user_id, "AAPL", -3, 110)
+        conn.execute("DELETE FROM prices")
+        report = performance(conn, user_id)
+        assert [(gain["shares"], gain["market_value"], gain["realized"]) for gain in report["gains"]] == [(0, 0, 30)], "sold out"
+    print("performance: reports hold for users with no prices and users who sold out")
+
+
+def run_structures(args):
+    """Check the quote circuit breaker, time the structures behind orders and the leaderboard, then check performance reports."""
+    configure(args)
+    seed(args)
+    check_circuit_breaker()
+    print(f"{'operation':<28}{'calls':>9}{'p50 us':>10}{'p99 us':>10}{'max us':>10}")
+    check_order_book(args)
+    check_leaderboard(args)
+    check_performance(args)
+
+
+def drive(args, results, one):
+    """Send --requests requests to each route in turn from --concurrency threads."""
+    for route in args.routes:
+        rngs = [random.Random(args.seed * 1000003 + i) for i in range(args.requests)]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as executor:
+            list(executor.map(lambda rng: one(route, rng), rngs))
+        results.elapsed[route] = time.perf_counter() - start
+
+
+def main():
+    args = parse_args()
+    if args.mode == "structures":
+        run_structures(args)
+        return
+    configure(args)
+    seed(args)
+    print(f"seeded {args.users} users and {args.transactions} transactions into {args.database}")
+    results = Results()
+    if args.mode == "client":
+        run_client(args, results)
+    else:
+        run_gunicorn(args, results)
+    results.report(args.routes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from contextlib import contextmanager
+from flask import g, has_app_context
+
+from metrics import FunctionCounter, Gauge
+
+
+# Database file, pool size and how long to wait on a locked database (seconds)
+DATABASE = os.environ.get("DATABASE", "database.db")
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 8))
+DB_BUSY_TIMEOUT = float(os.environ.get("DB_BUSY_TIMEOUT", 5))
+
+PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA temp_store = MEMORY",
+]
+
+
+# Callables passed each SQL statement as any pooled connection runs it
+statement_listeners = []
+
+
+# Callables passed the seconds each execute or fetch on a pooled connection took
+timing_listeners = []
+
+
+def _trace(statement):
+    for listener in statement_listeners:
+        listener(statement)
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that reports time spent executing statements and fetching rows to timing_listeners."""
+
+    def execute(self, *args):
+        return self._timed(super().execute, args)
+
+    def executemany(self, *args):
+        return self._timed(super().executemany, args)
+
+    def fetchone(self):
+        return self._timed(super().fetchone, ())
+
+    def fetchmany(self, *args):
+        return self._timed(super().fetchmany, args)
+
+    def fetchall(self):
+        return self._timed(super().fetchall, ())
+
+    def _timed(self, method, args):
+        if not timing_listeners:
+            return method(*args)
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            seconds = time.perf_counter() - start
+            for listener in timing_listeners:
+                listener(seconds)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose cursors, including those behind its execute shortcuts, are TimedCursors."""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+
+def connect(path=DATABASE):
+    """Open a tuned connection in autocommit mode; use transaction() for multi-statement writes."""
+    conn = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT, check_same_thread=False, isolation_level=None,
+                           factory=TimedConnection)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    conn.set_trace_callback(_trace)
+    return conn
+
+
+class ConnectionPool:
+    """Bounded pool of SQLite connections shared by request threads."""
+
+    def __init__(self, path=DATABASE, size=DB_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self.created = 0
+        self.in_use = 0
+        self.acquired = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=DB_BUSY_TIMEOUT):
+        """Take an idle connection, opening a new one while under size, otherwise wait for one."""
+        with self._lock:
+            self.acquired += 1
+            self.in_use += 1
+            if self._idle.empty() and self.created < self.size:
+                self.created += 1
+                create = True
+            else:
+                create = False
+        try:
+            if create:
+                return connect(self.path)
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+
+            # Every connection is busy, so wait for one to come back
+            start = time.monotonic()
+            try:
+                return self._idle.get(timeout=timeout)
+            finally:
+                with self._lock:
+                    self.waits += 1
+                    self.wait_seconds += time.monotonic() - start
+        except BaseException:
+            with self._lock:
+                self.in_use -= 1
+                if create:
+                    self.created -= 1
+            raise
+
+    def release(self, conn):
+        """Return a connection to the pool, abandoning any transaction left open."""
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            self.in_use -= 1
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of a with block."""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def stats(self):
+        """Return pool usage counters."""
+        with self._lock:
+            return {
+                "size": self.size,
+                "created": self.created,
+                "in_use": self.in_use,
+                "idle": self.created - self.in_use,
+                "acquired": self.acquired,
+                "waits": self.waits,
+                "wait_seconds": round(self.wait_seconds, 6),
+            }
+
+
+pool = ConnectionPool()
+
+pool_connections = Gauge("db_pool_connections", "Pooled database connections by state",
+                         lambda: {(state,): pool.stats()[state] for state in ("size", "created", "in_use", "idle")},
+                         ["state"])
+pool_waits = FunctionCounter("db_pool_waits_total", "Times a request waited for a pooled connection",
+                             lambda: pool.stats()["waits"])
+pool_wait_seconds = FunctionCounter("db_pool_wait_seconds_total", "Seconds spent waiting for pooled connections",
+                                    lambda: pool.stats()["wait_seconds"])
+
+
+def get_db():
+    """Return this request's connection, borrowing one from the pool on first use."""
+    if "db" not in g:
+        g.db = pool.acquire()
+    return g.db
+
+
+@contextmanager
+def connection():
+    """Yield the current request's connection when there is one, otherwise borrow one from the pool.
+
+    Code that may run during a request should use this rather than the pool
+    directly, so a request never holds two pooled connections at once.
+    """
+    if has_app_context():
+        yield get_db()
+    else:
+        with pool.connection() as conn:
+            yield conn
+
+
+def close_db(exception=None):
+    """Give the request's connection back to the pool."""
+    conn = g.pop("db", None)
+    if conn is not None:
+        pool.release(conn)
+
+
+def init_app(app):
+    """Return connections to the pool when each request ends."""
+    app.teardown_appcontext(close_db)
+
+
+@contextmanager
+def transaction(conn):
+    """Run a with block inside BEGIN IMMEDIATE, committing on success and rolling back on error."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
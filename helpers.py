@@ -1,10 +1,31 @@
+import asyncio
+import logging
 import os
-import requests
-import urllib.parse
+import threading
+import time
 
-from flask import redirect, render_template, request, session
+from collections import OrderedDict
+from flask import g, has_request_context, redirect, render_template, request, session
 from functools import wraps
 
+from metrics import Counter, Histogram
+from quotes import CircuitBreaker, QuoteUnavailable, get_provider
+
+
+# How long a cached quote stays fresh (seconds) and how many symbols to keep
+QUOTE_CACHE_TTL = float(os.environ.get("QUOTE_CACHE_TTL", 60))
+QUOTE_CACHE_SIZE = int(os.environ.get("QUOTE_CACHE_SIZE", 1024))
+
+# Consecutive provider failures that open the circuit breaker, and seconds before it retries
+QUOTE_BREAKER_THRESHOLD = int(os.environ.get("QUOTE_BREAKER_THRESHOLD", 5))
+QUOTE_BREAKER_RESET = float(os.environ.get("QUOTE_BREAKER_RESET", 30))
+
+# Most symbols lookup_many_async fetches at once
+QUOTE_CONCURRENCY = int(os.environ.get("QUOTE_CONCURRENCY", 8))
+
+quote_latency = Histogram("quote_request_seconds", "Quote provider call latency.", ["call"])
+quote_errors = Counter("quote_errors_total", "Quote provider calls that failed or were refused by the breaker.", ["reason"])
+
 
 def apology(message, code=400):
     """Render message as an apology to user."""
@@ -35,29 +56,221 @@ def login_required(f):
     return decorated_function
 
 
+class QuoteCache:
+    """Thread-safe quote cache with a freshness TTL and LRU eviction."""
+
+    def __init__(self, ttl=QUOTE_CACHE_TTL, maxsize=QUOTE_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, symbol, max_age=None):
+        """Return a cached quote for symbol no older than max_age (default the TTL) seconds, or None."""
+        with self._lock:
+            entry = self._entries.get(symbol)
+            if entry is None or time.monotonic() - entry[0] > (self.ttl if max_age is None else max_age):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(symbol)
+            self.hits += 1
+            return entry[1]
+
+    def last_known(self, symbol):
+        """Return the cached quote for symbol however old it is, or None."""
+        with self._lock:
+            entry = self._entries.get(symbol)
+            return entry[1] if entry else None
+
+    def set(self, symbol, quote, age=0):
+        """Store quote for symbol, fetched age seconds ago, evicting the least recently used entry if full."""
+        with self._lock:
+            self._entries[symbol] = (time.monotonic() - age, quote)
+            self._entries.move_to_end(symbol)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drop every cached quote."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return hit/miss counters and current size."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+logger = logging.getLogger("mockstock.quotes")
+
+quote_cache = QuoteCache()
+provider = get_provider()
+breaker = CircuitBreaker(QUOTE_BREAKER_THRESHOLD, QUOTE_BREAKER_RESET)
+
+# Callables notified with {symbol: quote} whenever fresh quotes arrive from the provider
+quote_listeners = []
+
+# Callables passed (call, seconds) after every upstream provider call
+provider_call_listeners = []
+
+# Optional quote store shared between processes and consulted before the provider, see refresher.QuoteStore
+shared_store = None
+
+
+def notify_quotes(quotes):
+    """Pass freshly fetched quotes to every registered listener.
+
+    A failing listener is logged and counted but never fails the lookup that
+    fetched the quotes, nor stops the listeners after it.
+    """
+    if quotes:
+        for listener in quote_listeners:
+            try:
+                listener(quotes)
+            except Exception:
+                quote_errors.inc(reason="listener")
+                logger.exception("quote listener %r failed", listener)
+
+
 def lookup(symbol):
-    """Look up quote for symbol."""
+    """Look up quote for symbol, consulting the request memo and quote cache before the provider."""
+    key = symbol.upper()
 
-    # Contact API
-    try:
-        url = f"https://cloud.iexapis.com/stable/stock/{urllib.parse.quote_plus(symbol)}/quote?token=pk_7e83c823d9f24d0e993c6d16659290ca"
-        response = requests.get(url)
-        response.raise_for_status()
-    except requests.RequestException:
-        return None
+    # Reuse a quote already resolved during this request
+    memo = g.setdefault("quotes", {}) if has_request_context() else {}
+    if key in memo:
+        return memo[key]
+
+    # Serve a fresh cached or shared quote, otherwise ask the provider, falling back to the last known quote
+    quote = quote_cache.get(key)
+    if quote is None and shared_store is not None:
+        quote, age = shared_store.get_many([key], QUOTE_CACHE_TTL).get(key, (None, 0))
+        if quote is not None:
+            quote_cache.set(key, quote, age)
+    if quote is None:
+        try:
+            quote = _call_provider(provider.quote, symbol, call="quote")
+        except QuoteUnavailable:
+            quote = quote_cache.last_known(key)
+        else:
+            if quote is not None:
+                quote_cache.set(key, quote)
+                notify_quotes({key: quote})
+
+    memo[key] = quote
+    return quote
+
+
+def lookup_many(symbols, max_age=None):
+    """Look up quotes for many symbols, fetching any that are not cached in one provider batch.
+
+    Cached and shared quotes older than max_age seconds (default the cache TTL)
+    are fetched again.
+    """
+    memo = g.setdefault("quotes", {}) if has_request_context() else {}
+    quotes, missing = _resolve_known(symbols, max_age, memo)
+
+    # Fetch the rest in a single provider batch, falling back to the last known quotes
+    if missing:
+        try:
+            fetched = _call_provider(provider.quotes, missing, call="batch")
+        except QuoteUnavailable:
+            for key in missing:
+                quotes[key] = quote_cache.last_known(key)
+        else:
+            _store(missing, fetched, quotes)
+
+    memo.update(quotes)
+    return quotes
+
+
+async def lookup_many_async(symbols, concurrency=QUOTE_CONCURRENCY, max_age=None):
+    """Look up quotes for many symbols, fetching uncached ones concurrently, one provider call per symbol.
+
+    Resolves the request memo, quote cache and shared store first, like
+    lookup_many. Suits providers without a batch call. Provider calls are
+    blocking, so each runs in a worker thread, at most `concurrency` at a time.
+    """
+    memo = g.setdefault("quotes", {}) if has_request_context() else {}
+    quotes, missing = _resolve_known(symbols, max_age, memo)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(key):
+        async with semaphore:
+            try:
+                return await asyncio.to_thread(_call_provider, provider.quote, key, call="quote")
+            except QuoteUnavailable:
+                quotes[key] = quote_cache.last_known(key)
+                return None
+
+    fetched = await asyncio.gather(*(fetch(key) for key in missing))
+    _store(missing, {key: quote for key, quote in zip(missing, fetched) if quote is not None}, quotes)
+    memo.update(quotes)
+    return quotes
+
+
+def _resolve_known(symbols, max_age, memo):
+    """Resolve symbols from the request memo, quote cache and shared store; return (quotes, keys still missing).
 
-    # Parse response
+    Cached and shared quotes older than max_age seconds (default the cache TTL) count as missing.
+    """
+    max_age = QUOTE_CACHE_TTL if max_age is None else max_age
+    quotes = {}
+    missing = []
+    for key in {symbol.upper() for symbol in symbols}:
+        if key in memo:
+            quotes[key] = memo[key]
+            continue
+        quote = quote_cache.get(key, max_age)
+        if quote is None:
+            missing.append(key)
+        else:
+            quotes[key] = quote
+    if missing and shared_store is not None:
+        for key, (quote, age) in shared_store.get_many(missing, max_age).items():
+            quote_cache.set(key, quote, age)
+            quotes[key] = quote
+        missing = [key for key in missing if key not in quotes]
+    return quotes, missing
+
+
+def _call_provider(fetch, argument, call):
+    """Call the provider through the circuit breaker, timing it; raises QuoteUnavailable if it is down."""
+    if not breaker.allow():
+        quote_errors.inc(reason="breaker_open")
+        raise QuoteUnavailable("circuit breaker open")
+    start = time.perf_counter()
     try:
-        quote = response.json()
-        return {
-            "name": quote["companyName"],
-            "price": float(quote["latestPrice"]),
-            "symbol": quote["symbol"]
-        }
-    except (KeyError, TypeError, ValueError):
-        return None
+        result = fetch(argument)
+    except QuoteUnavailable:
+        breaker.failure()
+        quote_errors.inc(reason="unavailable")
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        quote_latency.observe(seconds, call=call)
+        for listener in provider_call_listeners:
+            listener(call, seconds)
+    breaker.success()
+    return result
+
+
+def _store(keys, fetched, quotes):
+    """Cache fetched quotes for keys into quotes, marking unknown symbols None, and notify listeners."""
+    fresh = {}
+    for key in keys:
+        quote = fetched.get(key)
+        if quote is not None:
+            quote_cache.set(key, quote)
+            fresh[key] = quote
+        quotes.setdefault(key, quote)
+    notify_quotes(fresh)
 
 
 def usd(value):
     """Format value as USD."""
     return f"${value:,.2f}"
+
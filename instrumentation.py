@@ -0,0 +1,142 @@
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import time
+import uuid
+
+from collections import defaultdict
+from contextlib import contextmanager
+from flask import g, has_request_context, request
+from jinja2 import Template
+
+import db
+import helpers
+from metrics import Counter, Histogram
+
+
+# Write one JSON line per request to the mockstock.requests logger; set to 0 to turn off
+REQUEST_LOG = os.environ.get("REQUEST_LOG", "1") != "0"
+
+# Fraction of requests to run under cProfile, and how slow a profiled request must be to log its profile
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+PROFILE_SLOW_SECONDS = float(os.environ.get("PROFILE_SLOW_SECONDS", 1))
+
+# Functions listed in a logged profile
+PROFILE_TOP = 25
+
+request_latency = Histogram("http_request_seconds", "Request latency by route", ["route", "method", "status"])
+phase_latency = Histogram("http_request_phase_seconds", "Time spent per request in each phase", ["route", "phase"])
+sql_statements = Counter("http_request_sql_statements_total", "SQL statements run while serving requests", ["route"])
+quote_calls = Counter("http_request_quote_calls_total", "Upstream quote provider calls made while serving requests", ["route"])
+
+request_log = logging.getLogger("mockstock.requests")
+profile_log = logging.getLogger("mockstock.profile")
+
+
+def record_phase(phase, seconds, calls=1):
+    """Add seconds and calls to a phase of the current request; does nothing outside a request."""
+    if has_request_context() and "phases" in g:
+        g.phases[phase] += seconds
+        g.calls[phase] += calls
+
+
+@contextmanager
+def timed(phase):
+    """Record the time spent in a with block against a phase of the current request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(phase, time.perf_counter() - start)
+
+
+class TimedTemplate(Template):
+    """Template that records its rendering time in the render phase."""
+
+    def render(self, *args, **kwargs):
+        with timed("render"):
+            return super().render(*args, **kwargs)
+
+
+def _on_sql_time(seconds):
+    record_phase("sql", seconds, calls=0)
+
+
+def _on_statement(statement):
+    record_phase("sql", 0.0)
+
+
+def _on_provider_call(call, seconds):
+    record_phase("quote", seconds)
+
+
+def start_request():
+    """Give the request an id and start its timers, and sometimes its profiler."""
+    g.request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    g.phases = defaultdict(float)
+    g.calls = defaultdict(int)
+    g.profiler = None
+    if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+    g.started = time.perf_counter()
+
+
+def finish_request(response):
+    """Record the request's metrics, log it, and tag the response with its id."""
+    if "started" not in g:
+        return response
+    seconds = time.perf_counter() - g.started
+    if g.profiler is not None:
+        g.profiler.disable()
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+
+    # Per-route latency, phase timings and call counts
+    request_latency.observe(seconds, route=route, method=request.method, status=str(response.status_code))
+    for phase, phase_seconds in g.phases.items():
+        phase_latency.observe(phase_seconds, route=route, phase=phase)
+    sql_statements.inc(g.calls["sql"], route=route)
+    quote_calls.inc(g.calls["quote"], route=route)
+
+    if REQUEST_LOG:
+        request_log.info(json.dumps({
+            "request_id": g.request_id,
+            "method": request.method,
+            "path": request.path,
+            "route": route,
+            "status": response.status_code,
+            "duration_ms": round(seconds * 1000, 3),
+            "phases_ms": {phase: round(phase_seconds * 1000, 3) for phase, phase_seconds in g.phases.items()},
+            "sql_statements": g.calls["sql"],
+            "quote_calls": g.calls["quote"],
+        }))
+
+    # Log where a sampled slow request spent its time
+    if g.profiler is not None and seconds >= PROFILE_SLOW_SECONDS:
+        out = io.StringIO()
+        pstats.Stats(g.profiler, stream=out).sort_stats("cumulative").print_stats(PROFILE_TOP)
+        profile_log.warning("slow request %s %s %s took %.3fs\n%s", g.request_id, request.method, request.path,
+                            seconds, out.getvalue())
+
+    response.headers["X-Request-ID"] = g.request_id
+    return response
+
+
+def init_app(app):
+    """Time, count and log every request app serves."""
+    if REQUEST_LOG and not request_log.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        request_log.addHandler(handler)
+        request_log.setLevel(logging.INFO)
+        request_log.propagate = False
+    app.jinja_env.template_class = TimedTemplate
+    db.timing_listeners.append(_on_sql_time)
+    db.statement_listeners.append(_on_statement)
+    helpers.provider_call_listeners.append(_on_provider_call)
+    app.before_request(start_request)
+    app.after_request(finish_request)
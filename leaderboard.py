@@ -0,0 +1,231 @@
+import bisect
+import logging
+import os
+import threading
+import time
+
+from collections import defaultdict
+
+import db
+
+
+# Seconds between full rebuilds, which pick up changes the incremental sync can't see, such as deposits in other workers
+LEADERBOARD_REBUILD_INTERVAL = float(os.environ.get("LEADERBOARD_REBUILD_INTERVAL", 300))
+
+# Revaluing more than 1/RERANK_FRACTION of users at once re-sorts the ranking instead of moving each user
+RERANK_FRACTION = 16
+
+# Latest stored price per symbol, from the shared quotes table where it has one, otherwise the prices table
+LATEST_PRICES_SQL = """SELECT p.symbol, p.price_cents FROM prices p
+                       WHERE p.date = (SELECT MAX(date) FROM prices WHERE symbol = p.symbol)"""
+
+logger = logging.getLogger("mockstock.leaderboard")
+
+
+class Leaderboard:
+    """Every user's portfolio value, kept sorted so rank and top-N queries are a binary search.
+
+    Values are cash plus each position marked to its latest price, or to its
+    cost basis while the symbol has no price yet. They are kept current by
+    tailing the users, transactions and quotes tables (see sync) and by fresh
+    quotes arriving in this process. Moving a user is a binary search plus a
+    list insert and delete, so it is O(n) in memory moves, which stay in the
+    microseconds at tens of thousands of users.
+    """
+
+    def __init__(self, rebuild_interval=LEADERBOARD_REBUILD_INTERVAL):
+        self.rebuild_interval = rebuild_interval
+        self._lock = threading.RLock()
+        self._rebuilding = None
+        self._reset()
+
+    def _reset(self):
+        self._ranked = []
+        self._values = {}
+        self._names = {}
+        self._cash = {}
+        self._positions = defaultdict(dict)
+        self._holders = defaultdict(set)
+        self._prices = {}
+        self._last_user_id = 0
+        self._last_transaction_id = 0
+        self._last_cash_seq = 0
+        self._last_quote_time = 0.0
+        self._built_at = 0.0
+
+    def __len__(self):
+        return len(self._ranked)
+
+    def rebuild(self, conn):
+        """Load every user, position and latest price and rank them from scratch.
+
+        The load runs without the lock, so quotes and reads carry on meanwhile.
+        Prices and users changed during it are applied again after the swap.
+        """
+        with self._lock:
+            self._built_at = time.monotonic()
+            if self._rebuilding is None:
+                self._rebuilding = ({}, set())
+        fresh = Leaderboard(self.rebuild_interval)
+        try:
+            fresh._load(conn)
+        except BaseException:
+            with self._lock:
+                self._rebuilding = None
+            raise
+        with self._lock:
+            prices, user_ids = self._rebuilding
+            self._rebuilding = None
+            self.__dict__.update({name: value for name, value in vars(fresh).items()
+                                  if name not in ("rebuild_interval", "_lock", "_rebuilding")})
+            self._built_at = time.monotonic()
+            self.update_prices(prices)
+            if user_ids:
+                self.refresh(conn, user_ids)
+
+    def _load(self, conn):
+        self._last_transaction_id = conn.execute("SELECT COALESCE(MAX(transaction_id), 0) FROM transactions").fetchone()[0]
+        self._last_cash_seq = conn.execute("SELECT COALESCE(MAX(cash_seq), 0) FROM users").fetchone()[0]
+        self._prices.update(conn.execute(LATEST_PRICES_SQL).fetchall())
+        self._sync_quotes(conn)
+        rows = conn.execute("SELECT user_id, username, cash_cents FROM users").fetchall()
+        for user_id, username, cash_cents in rows:
+            self._names[user_id] = username
+            self._cash[user_id] = cash_cents
+            self._last_user_id = max(self._last_user_id, user_id)
+        for user_id, symbol, shares, cost_basis_cents in conn.execute("SELECT user_id, symbol, shares, cost_basis_cents FROM holdings"):
+            self._positions[user_id][symbol] = (shares, cost_basis_cents)
+            self._holders[symbol].add(user_id)
+        self._rerank(self._cash)
+
+    def sync(self, conn):
+        """Apply changes written since the last sync, by any worker process.
+
+        New users are added, users with new ledger entries or cash changes
+        (such as deposits) have their cash and positions reloaded, and quotes
+        stored since the last sync are applied. Every rebuild_interval seconds
+        a full rebuild also starts in a background thread.
+        """
+        with self._lock:
+            if self._rebuilding is None and time.monotonic() - self._built_at >= self.rebuild_interval:
+
+                # Start recording changes now, so none made before the thread runs are lost in the swap
+                self._rebuilding = ({}, set())
+                threading.Thread(target=self._rebuild_in_background, name="leaderboard-rebuild", daemon=True).start()
+            rows = conn.execute("SELECT user_id, username, cash_cents FROM users WHERE user_id > ?",
+                                (self._last_user_id,)).fetchall()
+            for user_id, username, cash_cents in rows:
+                self._names[user_id] = username
+                self._cash[user_id] = cash_cents
+                self._revalue(user_id)
+                self._last_user_id = max(self._last_user_id, user_id)
+            changed = set()
+            rows = conn.execute("SELECT transaction_id, user_id FROM transactions WHERE transaction_id > ?",
+                                (self._last_transaction_id,)).fetchall()
+            if rows:
+                self._last_transaction_id = max(row[0] for row in rows)
+                changed.update(row[1] for row in rows)
+            rows = conn.execute("SELECT cash_seq, user_id FROM users WHERE cash_seq > ?", (self._last_cash_seq,)).fetchall()
+            if rows:
+                self._last_cash_seq = max(row[0] for row in rows)
+                changed.update(row[1] for row in rows)
+            if changed:
+                self.refresh(conn, changed)
+            self._sync_quotes(conn)
+
+    def _rebuild_in_background(self):
+        try:
+            with db.pool.connection() as conn:
+                self.rebuild(conn)
+        except Exception:
+            logger.exception("rebuilding the leaderboard failed")
+
+    def refresh(self, conn, user_ids):
+        """Reload the cash and positions of user_ids from the database, e.g. after a deposit."""
+        user_ids = list(user_ids)
+        marks = ",".join("?" * len(user_ids))
+        with self._lock:
+            if self._rebuilding is not None:
+                self._rebuilding[1].update(user_ids)
+            cash = dict(conn.execute(f"SELECT user_id, cash_cents FROM users WHERE user_id IN ({marks})", user_ids).fetchall())
+            holdings = conn.execute(f"SELECT user_id, symbol, shares, cost_basis_cents FROM holdings WHERE user_id IN ({marks})",
+                                    user_ids).fetchall()
+            for user_id in user_ids:
+                for symbol in self._positions.pop(user_id, {}):
+                    self._holders[symbol].discard(user_id)
+            for user_id, symbol, shares, cost_basis_cents in holdings:
+                self._positions[user_id][symbol] = (shares, cost_basis_cents)
+                self._holders[symbol].add(user_id)
+            for user_id in user_ids:
+                if user_id in cash:
+                    self._cash[user_id] = cash[user_id]
+                    self._revalue(user_id)
+
+    def on_quotes(self, quotes):
+        """Revalue the holders of freshly fetched quotes; registered as a helpers quote listener."""
+        self.update_prices({symbol: round(quote["price"] * 100) for symbol, quote in quotes.items()})
+
+    def update_prices(self, prices):
+        """Apply {symbol: price in cents}, revaluing only the users holding a symbol whose price moved."""
+        with self._lock:
+            if self._rebuilding is not None:
+                self._rebuilding[0].update(prices)
+            moved = set()
+            for symbol, price_cents in prices.items():
+                if self._prices.get(symbol) != price_cents:
+                    self._prices[symbol] = price_cents
+                    moved |= self._holders.get(symbol, set())
+            self._rerank(moved)
+
+    def top(self, n):
+        """Return the n most valuable portfolios as dicts with rank, user_id, username and value_cents."""
+        with self._lock:
+            return [self._entry(user_id, -value) for value, user_id in self._ranked[:n]]
+
+    def rank(self, user_id):
+        """Return user_id's entry, or None if they aren't ranked."""
+        with self._lock:
+            if user_id not in self._values:
+                return None
+            return self._entry(user_id, self._values[user_id])
+
+    def _entry(self, user_id, value_cents):
+        # Users with equal values share the best rank among them
+        return {"rank": bisect.bisect_left(self._ranked, (-value_cents,)) + 1, "user_id": user_id,
+                "username": self._names.get(user_id), "value_cents": value_cents}
+
+    def _value(self, user_id):
+        value = self._cash.get(user_id, 0)
+        for symbol, (shares, cost_basis_cents) in self._positions.get(user_id, {}).items():
+            price_cents = self._prices.get(symbol)
+            value += cost_basis_cents if price_cents is None else round(shares * price_cents)
+        return value
+
+    def _rerank(self, user_ids):
+        """Revalue user_ids, re-sorting the whole ranking at once when many of them moved."""
+        if len(user_ids) * RERANK_FRACTION < len(self._ranked):
+            for user_id in user_ids:
+                self._revalue(user_id)
+            return
+        for user_id in user_ids:
+            self._values[user_id] = self._value(user_id)
+        self._ranked = sorted((-value, user_id) for user_id, value in self._values.items())
+
+    def _revalue(self, user_id):
+        """Recompute user_id's value and move them to their new place in the ranking."""
+        value = self._value(user_id)
+        old = self._values.get(user_id)
+        if old == value:
+            return
+        if old is not None:
+            del self._ranked[bisect.bisect_left(self._ranked, (-old, user_id))]
+        bisect.insort(self._ranked, (-value, user_id))
+        self._values[user_id] = value
+
+    def _sync_quotes(self, conn):
+        rows = conn.execute("SELECT symbol, price_cents, updated_at FROM quotes WHERE updated_at > ?",
+                            (self._last_quote_time,)).fetchall()
+        if rows:
+            self._last_quote_time = max(row[2] for row in rows)
+            self.update_prices({symbol: price_cents for symbol, price_cents, _ in rows})
+
@@ -0,0 +1,138 @@
+import bisect
+import threading
+
+
+# Every metric created, in creation order
+registry = []
+
+
+class Counter:
+    """Monotonic counter, optionally split by label values."""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def stats(self):
+        """Return {label values: count}."""
+        with self._lock:
+            return {",".join(key) or "total": value for key, value in self._values.items()}
+
+
+class Histogram:
+    """Cumulative-bucket histogram of observed values, optionally split by label values."""
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            series["counts"][bisect.bisect_left(self.buckets, value)] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def stats(self):
+        """Return {label values: {"count", "sum", "buckets": {upper bound: cumulative count}}}."""
+        with self._lock:
+            stats = {}
+            for key, series in self._series.items():
+                cumulative = 0
+                buckets = {}
+                for bound, count in zip(self.buckets + ("+Inf",), series["counts"]):
+                    cumulative += count
+                    buckets[str(bound)] = cumulative
+                stats[",".join(key) or "total"] = {"count": series["count"], "sum": round(series["sum"], 6), "buckets": buckets}
+            return stats
+
+
+class Gauge:
+    """Value read from a function whenever metrics are collected, optionally split by label values.
+
+    The function returns a number, or {label values tuple: number} when the gauge has labels.
+    """
+
+    def __init__(self, name, documentation, function, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        registry.append(self)
+
+    def stats(self):
+        value = self.function()
+        if not self.labelnames:
+            return {"total": value}
+        return {",".join(key): number for key, number in value.items()}
+
+
+class FunctionCounter(Gauge):
+    """Monotonic total read from a function whenever metrics are collected, such as a count another object keeps."""
+
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def render():
+    """Return every registered metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in registry:
+        if isinstance(metric, Counter):
+            kind = "counter"
+        elif isinstance(metric, Histogram):
+            kind = "histogram"
+        elif isinstance(metric, FunctionCounter):
+            kind = "counter"
+        else:
+            kind = "gauge"
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {kind}")
+
+        if isinstance(metric, Counter):
+            with metric._lock:
+                values = dict(metric._values)
+            for key, value in values.items():
+                lines.append(f"{metric.name}{_labels(metric.labelnames, key)} {value}")
+
+        elif isinstance(metric, Histogram):
+            with metric._lock:
+                series = {key: (list(data["counts"]), data["sum"], data["count"]) for key, data in metric._series.items()}
+            for key, (counts, total, count) in series.items():
+                cumulative = 0
+                for bound, bucket in zip(metric.buckets + ("+Inf",), counts):
+                    cumulative += bucket
+                    lines.append(f"{metric.name}_bucket{_labels(metric.labelnames, key, [('le', bound)])} {cumulative}")
+                lines.append(f"{metric.name}_sum{_labels(metric.labelnames, key)} {total}")
+                lines.append(f"{metric.name}_count{_labels(metric.labelnames, key)} {count}")
+
+        else:
+            value = metric.function()
+            values = value.items() if metric.labelnames else [((), value)]
+            for key, number in values:
+                lines.append(f"{metric.name}{_labels(metric.labelnames, key)} {number}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,273 @@
+def create_tables(c):
+    """Create the original users and transactions tables."""
+    c.execute("""CREATE TABLE IF NOT EXISTS users
+               (
+                   user_id INTEGER PRIMARY KEY,
+                   username TEXT NOT NULL,
+                   password_hash TEXT NOT NULL,
+                   cash REAL
+               )
+               """)
+    c.execute("""CREATE TABLE IF NOT EXISTS transactions
+               (
+                   transaction_id INTEGER PRIMARY KEY,
+                   symbol TEXT NOT NULL,
+                   shares REAL NOT NULL,
+                   price REAL NOT NULL,
+                   timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+                   sum_shares REAL,
+                   user_id INTEGER NOT NULL,
+                   FOREIGN KEY (user_id) REFERENCES users (user_id)
+               )
+               """)
+
+
+def create_holdings(c):
+    """Create the holdings table and fill it from the existing transactions."""
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'holdings'")
+    if c.fetchone() is not None:
+        return
+    c.execute("""CREATE TABLE holdings
+               (
+                   user_id INTEGER NOT NULL,
+                   symbol TEXT NOT NULL,
+                   shares REAL NOT NULL,
+                   cost_basis REAL NOT NULL,
+                   PRIMARY KEY (user_id, symbol),
+                   FOREIGN KEY (user_id) REFERENCES users (user_id)
+               )
+               """)
+
+    # Replay the ledger, reducing cost basis at average cost on sells
+    holdings = {}
+    c.execute("SELECT user_id, symbol, shares, price FROM transactions ORDER BY transaction_id")
+    for user_id, symbol, shares, price in c.fetchall():
+        held, cost_basis = holdings.get((user_id, symbol.upper()), (0, 0))
+        if shares >= 0:
+            cost_basis += shares * price
+        elif held > 0:
+            cost_basis -= cost_basis * min(-shares, held) / held
+        holdings[(user_id, symbol.upper())] = (held + shares, cost_basis)
+    c.executemany("INSERT INTO holdings (user_id, symbol, shares, cost_basis) VALUES (?,?,?,?)",
+                  [(user_id, symbol, shares, cost_basis)
+                   for (user_id, symbol), (shares, cost_basis) in holdings.items() if shares > 0])
+
+
+def add_indexes(c):
+    """Index the lookups every page makes."""
+    c.execute("CREATE INDEX IF NOT EXISTS users_username ON users (username)")
+    c.execute("CREATE INDEX IF NOT EXISTS transactions_user_id_symbol ON transactions (user_id, symbol)")
+
+
+def use_integer_cents(c):
+    """Store money as integer cents and make usernames unique.
+
+    SQLite can't alter column types or add constraints in place, so each table
+    is rebuilt and its rows copied across. The unused sum_shares column is
+    dropped along the way.
+    """
+    c.execute("""CREATE TABLE users_new
+               (
+                   user_id INTEGER PRIMARY KEY,
+                   username TEXT NOT NULL UNIQUE,
+                   password_hash TEXT NOT NULL,
+                   cash_cents INTEGER NOT NULL DEFAULT 0
+               )
+               """)
+    c.execute("""INSERT INTO users_new (user_id, username, password_hash, cash_cents)
+                 SELECT user_id, username, password_hash, CAST(ROUND(COALESCE(cash, 0) * 100) AS INTEGER) FROM users""")
+    c.execute("DROP TABLE users")
+    c.execute("ALTER TABLE users_new RENAME TO users")
+
+    c.execute("""CREATE TABLE transactions_new
+               (
+                   transaction_id INTEGER PRIMARY KEY,
+                   symbol TEXT NOT NULL,
+                   shares REAL NOT NULL,
+                   price_cents INTEGER NOT NULL,
+                   timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+                   user_id INTEGER NOT NULL,
+                   FOREIGN KEY (user_id) REFERENCES users (user_id)
+               )
+               """)
+    c.execute("""INSERT INTO transactions_new (transaction_id, symbol, shares, price_cents, timestamp, user_id)
+                 SELECT transaction_id, UPPER(symbol), shares, CAST(ROUND(price * 100) AS INTEGER), timestamp, user_id
+                 FROM transactions""")
+    c.execute("DROP TABLE transactions")
+    c.execute("ALTER TABLE transactions_new RENAME TO transactions")
+    c.execute("CREATE INDEX transactions_user_id_symbol ON transactions (user_id, symbol)")
+
+    c.execute("""CREATE TABLE holdings_new
+               (
+                   user_id INTEGER NOT NULL,
+                   symbol TEXT NOT NULL,
+                   shares REAL NOT NULL,
+                   cost_basis_cents INTEGER NOT NULL,
+                   PRIMARY KEY (user_id, symbol),
+                   FOREIGN KEY (user_id) REFERENCES users (user_id)
+               )
+               """)
+    c.execute("""INSERT INTO holdings_new (user_id, symbol, shares, cost_basis_cents)
+                 SELECT user_id, symbol, shares, CAST(ROUND(cost_basis * 100) AS INTEGER) FROM holdings""")
+    c.execute("DROP TABLE holdings")
+    c.execute("ALTER TABLE holdings_new RENAME TO holdings")
+
+    # The UNIQUE constraint's index now serves username lookups
+    c.execute("DROP INDEX IF EXISTS users_username")
+
+
+def index_transaction_pages(c):
+    """Index each user's transactions in id order for keyset pagination."""
+    c.execute("CREATE INDEX IF NOT EXISTS transactions_user_id_transaction_id ON transactions (user_id, transaction_id)")
+
+
+def create_performance_tables(c):
+    """Create price history, daily portfolio snapshots and realized gains, seeded from the ledger."""
+    c.execute("""CREATE TABLE prices
+               (
+                   symbol TEXT NOT NULL,
+                   date TEXT NOT NULL,
+                   price_cents INTEGER NOT NULL,
+                   PRIMARY KEY (symbol, date)
+               )
+               """)
+    c.execute("""CREATE TABLE portfolio_snapshots
+               (
+                   user_id INTEGER NOT NULL,
+                   date TEXT NOT NULL,
+                   cash_cents INTEGER NOT NULL,
+                   market_value_cents INTEGER NOT NULL,
+                   PRIMARY KEY (user_id, date),
+                   FOREIGN KEY (user_id) REFERENCES users (user_id)
+               )
+               """)
+    c.execute("""CREATE TABLE realized_gains
+               (
+                   user_id INTEGER NOT NULL,
+                   symbol TEXT NOT NULL,
+                   realized_cents INTEGER NOT NULL,
+                   PRIMARY KEY (user_id, symbol),
+                   FOREIGN KEY (user_id) REFERENCES users (user_id)
+               )
+               """)
+    c.execute("CREATE INDEX holdings_symbol ON holdings (symbol)")
+    c.execute("CREATE INDEX transactions_user_id_timestamp ON transactions (user_id, timestamp)")
+
+    # Each day's last trade price is the earliest price history we have
+    c.execute("""INSERT INTO prices (symbol, date, price_cents)
+                 SELECT symbol, date(timestamp), price_cents FROM transactions
+                 WHERE transaction_id IN (SELECT MAX(transaction_id) FROM transactions GROUP BY symbol, date(timestamp))""")
+
+    # Replay the ledger at average cost to find gains already realized by sells
+    positions = {}
+    realized = {}
+    c.execute("SELECT user_id, symbol, shares, price_cents FROM transactions ORDER BY transaction_id")
+    for user_id, symbol, shares, price_cents in c.fetchall():
+        held, cost_basis = positions.get((user_id, symbol), (0, 0))
+        if shares >= 0:
+            cost_basis += shares * price_cents
+        elif held > 0:
+            sold = min(-shares, held)
+            cost = cost_basis * sold / held
+            realized[(user_id, symbol)] = realized.get((user_id, symbol), 0) + sold * price_cents - cost
+            cost_basis -= cost
+        positions[(user_id, symbol)] = (held + shares, cost_basis)
+    c.executemany("INSERT INTO realized_gains (user_id, symbol, realized_cents) VALUES (?,?,?)",
+                  [(user_id, symbol, round(gain)) for (user_id, symbol), gain in realized.items()])
+
+
+def create_quotes(c):
+    """Create the latest-quote table shared by every worker process."""
+    c.execute("""CREATE TABLE quotes
+               (
+                   symbol TEXT PRIMARY KEY,
+                   name TEXT NOT NULL,
+                   price_cents INTEGER NOT NULL,
+                   updated_at REAL NOT NULL
+               )
+               """)
+
+
+def create_sessions(c):
+    """Create the server-side session table, indexed by expiry for sweeping."""
+    c.execute("""CREATE TABLE sessions
+               (
+                   sid TEXT PRIMARY KEY,
+                   data TEXT NOT NULL,
+                   expires_at REAL NOT NULL
+               )
+               """)
+    c.execute("CREATE INDEX sessions_expires_at ON sessions (expires_at)")
+
+
+def create_orders(c):
+    """Create the resting limit and stop orders table."""
+    c.execute("""CREATE TABLE orders
+               (
+                   order_id INTEGER PRIMARY KEY,
+                   user_id INTEGER NOT NULL,
+                   symbol TEXT NOT NULL,
+                   side TEXT NOT NULL CHECK (side IN ('buy', 'sell')),
+                   kind TEXT NOT NULL CHECK (kind IN ('limit', 'stop')),
+                   shares INTEGER NOT NULL CHECK (shares > 0),
+                   trigger_cents INTEGER NOT NULL CHECK (trigger_cents > 0),
+                   status TEXT NOT NULL DEFAULT 'open' CHECK (status IN ('open', 'filled', 'rejected', 'cancelled')),
+                   created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                   closed_at TEXT,
+                   fill_price_cents INTEGER,
+                   transaction_id INTEGER,
+                   error TEXT,
+                   FOREIGN KEY (user_id) REFERENCES users (user_id)
+               )
+               """)
+    c.execute("CREATE INDEX orders_user_id_order_id ON orders (user_id, order_id)")
+
+
+def index_open_orders(c):
+    """Index the symbols of open orders, which the quote refresher keeps warm."""
+    c.execute("CREATE INDEX orders_open_symbol ON orders (symbol) WHERE status = 'open'")
+
+
+def track_cash_changes(c):
+    """Number every change to a user's cash, so the leaderboard can tail deposits made by any worker."""
+    c.execute("ALTER TABLE users ADD COLUMN cash_seq INTEGER NOT NULL DEFAULT 0")
+    c.execute("CREATE INDEX users_cash_seq ON users (cash_seq)")
+    c.execute("""CREATE TRIGGER users_cash_changed AFTER UPDATE OF cash_cents ON users
+               BEGIN
+                   UPDATE users SET cash_seq = (SELECT MAX(cash_seq) FROM users) + 1 WHERE user_id = NEW.user_id;
+               END
+               """)
+
+
+# Append new migrations to the end; never reorder or edit applied ones
+MIGRATIONS = [
+    create_tables,
+    create_holdings,
+    add_indexes,
+    use_integer_cents,
+    index_transaction_pages,
+    create_performance_tables,
+    create_quotes,
+    create_sessions,
+    create_orders,
+    index_open_orders,
+    track_cash_changes,
+]
+
+
+def migrate(conn):
+    """Apply every migration newer than the database's user_version pragma, each in its own transaction."""
+    c = conn.cursor()
+    for version, migration in enumerate(MIGRATIONS, start=1):
+
+        # Take the write lock before checking, so concurrent workers apply each migration once
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            c.execute("PRAGMA user_version")
+            if c.fetchone()[0] < version:
+                migration(c)
+                c.execute(f"PRAGMA user_version = {version}")
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
@@ -0,0 +1,221 @@
+import heapq
+import logging
+import threading
+
+from collections import defaultdict
+
+import db
+from db import transaction
+from trading import TradeError, apply_trade
+
+
+# Cancelled entries a symbol's heaps may hold before they are rebuilt without them
+COMPACT_THRESHOLD = 1024
+
+ORDER_COLUMNS = "order_id, user_id, symbol, side, kind, shares, trigger_cents"
+
+logger = logging.getLogger("mockstock.orders")
+
+
+def fires_below(order):
+    """Return True if order triggers when the price falls to its trigger (buy limits and sell stops)."""
+    return (order["side"] == "buy") == (order["kind"] == "limit")
+
+
+def crosses(order, price_cents):
+    """Return True if price_cents reaches order's trigger."""
+    return price_cents <= order["trigger_cents"] if fires_below(order) else price_cents >= order["trigger_cents"]
+
+
+class OrderBook:
+    """Open orders indexed by trigger price, two heaps per symbol.
+
+    Orders that trigger as the price falls sit in a max-heap and orders that
+    trigger as it rises sit in a min-heap, so a price update only pops the
+    orders it crossed and checking an untouched symbol costs two comparisons.
+    Removed orders stay in their heap until popped or compacted away.
+    """
+
+    def __init__(self):
+        self._below = defaultdict(list)
+        self._above = defaultdict(list)
+        self._open = {}
+        self._stale = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._open)
+
+    def add(self, order):
+        """Add an open order dict; adding an order already in the book does nothing."""
+        with self._lock:
+            if order["order_id"] in self._open:
+                return
+            self._open[order["order_id"]] = order
+            self._push(order)
+
+    def remove(self, order_id):
+        """Drop an order from the book, returning it, or None if it wasn't there."""
+        with self._lock:
+            order = self._open.pop(order_id, None)
+            if order is not None:
+                symbol = order["symbol"]
+                self._stale[symbol] += 1
+                if self._stale[symbol] > COMPACT_THRESHOLD:
+                    self._compact(symbol)
+            return order
+
+    def crossed(self, symbol, price_cents):
+        """Remove and return the orders for symbol whose trigger price_cents reached, oldest first."""
+        fired = []
+        with self._lock:
+            below = self._below.get(symbol)
+            while below and -below[0][0] >= price_cents:
+                fired.append(heapq.heappop(below)[1])
+            above = self._above.get(symbol)
+            while above and above[0][0] <= price_cents:
+                fired.append(heapq.heappop(above)[1])
+            orders = []
+            for order_id in sorted(fired):
+                order = self._open.pop(order_id, None)
+                if order is None:
+                    self._stale[symbol] -= 1
+                else:
+                    orders.append(order)
+            return orders
+
+    def _push(self, order):
+        if fires_below(order):
+            heapq.heappush(self._below[order["symbol"]], (-order["trigger_cents"], order["order_id"]))
+        else:
+            heapq.heappush(self._above[order["symbol"]], (order["trigger_cents"], order["order_id"]))
+
+    def _compact(self, symbol):
+        """Rebuild symbol's heaps from its open orders, discarding removed entries."""
+        self._below[symbol] = [entry for entry in self._below[symbol] if entry[1] in self._open]
+        self._above[symbol] = [entry for entry in self._above[symbol] if entry[1] in self._open]
+        heapq.heapify(self._below[symbol])
+        heapq.heapify(self._above[symbol])
+        self._stale[symbol] = 0
+
+
+class OrderEngine:
+    """Fill resting limit and stop orders as quotes cross their trigger prices.
+
+    Every worker process keeps its own book. New orders from other processes
+    are picked up from the orders table before each match, and a fill only
+    goes ahead if it is the one to move its order out of the open state, so an
+    order is never filled twice or after being cancelled elsewhere.
+    """
+
+    def __init__(self):
+        self.book = OrderBook()
+        self.last_order_id = 0
+        self._sync_lock = threading.Lock()
+
+    def sync(self, conn):
+        """Add orders placed since the last sync, by any process, to the book."""
+        with self._sync_lock:
+            rows = conn.execute(f"SELECT {ORDER_COLUMNS} FROM orders WHERE order_id > ? AND status = 'open' ORDER BY order_id",
+                                (self.last_order_id,)).fetchall()
+            for row in rows:
+                self.book.add(dict(zip(ORDER_COLUMNS.split(", "), row)))
+                self.last_order_id = row[0]
+
+    def place(self, conn, user_id, symbol, side, kind, shares, trigger_cents, price_cents=None):
+        """Store a new open order, returning its id.
+
+        If price_cents, the current price, already crosses the trigger the
+        order fills straight away; otherwise it rests in the book.
+        """
+        cursor = conn.execute("INSERT INTO orders (user_id, symbol, side, kind, shares, trigger_cents) VALUES (?,?,?,?,?,?)",
+                              (user_id, symbol.upper(), side, kind, shares, trigger_cents))
+        order = {"order_id": cursor.lastrowid, "user_id": user_id, "symbol": symbol.upper(), "side": side,
+                 "kind": kind, "shares": shares, "trigger_cents": trigger_cents}
+        if price_cents is not None and crosses(order, price_cents):
+            self.fill(conn, order, price_cents)
+        else:
+            self.book.add(order)
+        return cursor.lastrowid
+
+    def cancel(self, conn, user_id, order_id):
+        """Cancel user_id's open order; return False if it isn't theirs or is no longer open."""
+        cursor = conn.execute("""UPDATE orders SET status = 'cancelled', closed_at = CURRENT_TIMESTAMP
+                                 WHERE order_id = ? AND user_id = ? AND status = 'open'""", (order_id, user_id))
+        if cursor.rowcount == 0:
+            return False
+        self.book.remove(order_id)
+        return True
+
+    def match(self, conn, prices):
+        """Fill every order crossed by {symbol: price in cents}; return the ids of orders filled."""
+        self.sync(conn)
+        filled = []
+        for symbol, price_cents in prices.items():
+            orders = self.book.crossed(symbol, price_cents)
+            for i, order in enumerate(orders):
+                try:
+                    if self.fill(conn, order, price_cents):
+                        filled.append(order["order_id"])
+                except Exception:
+
+                    # Put back the orders not filled, so the next update retries them
+                    for unfilled in orders[i:]:
+                        self.book.add(unfilled)
+                    raise
+        return filled
+
+    def fill(self, conn, order, price_cents):
+        """Trade a triggered order at price_cents through the ledger, or reject it if the trade fails.
+
+        Returns True if the order filled.
+        """
+        with transaction(conn):
+
+            # Claim the order, unless another process already filled or cancelled it
+            cursor = conn.execute("UPDATE orders SET status = 'filled', closed_at = CURRENT_TIMESTAMP WHERE order_id = ? AND status = 'open'",
+                                  (order["order_id"],))
+            if cursor.rowcount == 0:
+                return False
+
+            shares = order["shares"] if order["side"] == "buy" else -order["shares"]
+            try:
+                transaction_id = apply_trade(conn, order["user_id"], order["symbol"], shares, price_cents)
+            except TradeError as e:
+                conn.execute("UPDATE orders SET status = 'rejected', error = ? WHERE order_id = ?", (str(e), order["order_id"]))
+                return False
+            conn.execute("UPDATE orders SET fill_price_cents = ?, transaction_id = ? WHERE order_id = ?",
+                         (price_cents, transaction_id, order["order_id"]))
+            return True
+
+
+
+class OrderMatcher(threading.Thread):
+    """Daemon thread that matches orders against fresh quotes, off the request that fetched them.
+
+    Quote listeners only record the latest price per symbol, so a burst of
+    updates collapses into one match against the newest prices.
+    """
+
+    def __init__(self, engine):
+        super().__init__(name="order-matcher", daemon=True)
+        self.engine = engine
+        self._pending = {}
+        self._changed = threading.Condition()
+
+    def on_quotes(self, quotes):
+        """Queue freshly fetched quotes for matching; registered as a helpers quote listener."""
+        with self._changed:
+            self._pending.update({symbol: round(quote["price"] * 100) for symbol, quote in quotes.items()})
+            self._changed.notify()
+
+    def run(self):
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: self._pending)
+                prices, self._pending = self._pending, {}
+            try:
+                with db.connection() as conn:
+                    self.engine.match(conn, prices)
+            except Exception:
+                logger.exception("matching orders failed")
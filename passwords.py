@@ -0,0 +1,130 @@
+import multiprocessing
+import os
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+# Werkzeug hash method and cost for new hashes; logins upgrade hashes made with anything else
+PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "pbkdf2:sha256:260000")
+PASSWORD_SALT_LENGTH = int(os.environ.get("PASSWORD_SALT_LENGTH", 16))
+
+# Processes hashing passwords per worker (0 hashes in the request thread), and hashes waiting for one at most
+PASSWORD_WORKERS = int(os.environ.get("PASSWORD_WORKERS", min(4, os.cpu_count() or 1)))
+PASSWORD_QUEUE_SIZE = int(os.environ.get("PASSWORD_QUEUE_SIZE", max(1, PASSWORD_WORKERS) * 4))
+
+# Seconds a request waits for room in the hashing queue before giving up
+PASSWORD_QUEUE_TIMEOUT = float(os.environ.get("PASSWORD_QUEUE_TIMEOUT", 2))
+
+# Login and registration attempts allowed per second and in a burst, per client IP and per username; a rate of 0 turns a limit off
+LOGIN_IP_RATE = float(os.environ.get("LOGIN_IP_RATE", 1))
+LOGIN_IP_BURST = float(os.environ.get("LOGIN_IP_BURST", 20))
+LOGIN_USER_RATE = float(os.environ.get("LOGIN_USER_RATE", 0.1))
+LOGIN_USER_BURST = float(os.environ.get("LOGIN_USER_BURST", 5))
+
+
+class HashingBusy(Exception):
+    """Raised when the hashing queue stays full for longer than PASSWORD_QUEUE_TIMEOUT."""
+
+
+class TokenBucketLimiter:
+    """Per-key token buckets holding up to burst tokens, refilled at rate tokens per second."""
+
+    # Keys tracked before buckets that have refilled completely are forgotten
+    MAX_KEYS = 10000
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        """Take a token from key's bucket, returning False if it is empty."""
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+            if len(self._buckets) > self.MAX_KEYS:
+                self._prune(now)
+            return allowed
+
+    def _prune(self, now):
+        """Forget buckets that have refilled, since a fresh bucket is identical."""
+        self._buckets = {key: (tokens, updated) for key, (tokens, updated) in self._buckets.items()
+                         if tokens + (now - updated) * self.rate < self.burst}
+
+
+ip_limiter = TokenBucketLimiter(LOGIN_IP_RATE, LOGIN_IP_BURST)
+user_limiter = TokenBucketLimiter(LOGIN_USER_RATE, LOGIN_USER_BURST)
+
+
+def allow_attempt(ip, username=None):
+    """Return False if ip, or username when given, has run out of login attempts."""
+    allowed = ip_limiter.allow(ip)
+    if username is not None:
+        allowed = user_limiter.allow(username.lower()) and allowed
+    return allowed
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(PASSWORD_QUEUE_SIZE)
+
+
+def _get_executor():
+    """Start the hashing processes on first use, so each server worker gets its own after forking."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(PASSWORD_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _executor
+
+
+def _replace_executor(broken):
+    """Discard broken, a pool that lost a process, so the next call starts a fresh one."""
+    global _executor
+    with _executor_lock:
+        if _executor is broken:
+            _executor = None
+    broken.shutdown(wait=False)
+
+
+def _run(function, *args):
+    """Run function in the hashing pool, waiting at most PASSWORD_QUEUE_TIMEOUT for room in its queue."""
+    if not PASSWORD_WORKERS:
+        return function(*args)
+    if not _slots.acquire(timeout=PASSWORD_QUEUE_TIMEOUT):
+        raise HashingBusy("password hashing queue is full")
+    try:
+        # A hashing process that died breaks the whole pool, so retry once in a new one
+        executor = _get_executor()
+        try:
+            return executor.submit(function, *args).result()
+        except BrokenProcessPool:
+            _replace_executor(executor)
+            return _get_executor().submit(function, *args).result()
+    finally:
+        _slots.release()
+
+
+def hash_password(password):
+    """Hash password with the configured method and cost."""
+    return _run(generate_password_hash, password, PASSWORD_HASH_METHOD, PASSWORD_SALT_LENGTH)
+
+
+def check_password(password_hash, password):
+    """Return True if password matches password_hash."""
+    return _run(check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash):
+    """Return True if password_hash wasn't made with the configured method and cost."""
+    return password_hash.split("$", 1)[0] != PASSWORD_HASH_METHOD
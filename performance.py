@@ -0,0 +1,223 @@
+import logging
+import threading
+import time
+
+import pandas as pd
+
+from datetime import datetime, timezone
+
+import db
+
+
+# Rebuild users' snapshots for a day (bound twice) from cash, holdings and each symbol's latest price on or before it
+SNAPSHOT_SQL = """INSERT OR REPLACE INTO portfolio_snapshots (user_id, date, cash_cents, market_value_cents)
+                  SELECT u.user_id, ?, u.cash_cents,
+                         COALESCE(SUM(COALESCE(ROUND(h.shares * (SELECT p.price_cents FROM prices p
+                                                                  WHERE p.symbol = h.symbol AND p.date <= ?
+                                                                  ORDER BY p.date DESC LIMIT 1)),
+                                               h.cost_basis_cents)), 0)
+                  FROM users u LEFT JOIN holdings h ON h.user_id = u.user_id
+                  WHERE u.user_id IN ({users})
+                  GROUP BY u.user_id"""
+
+# Holders whose snapshots are refreshed per transaction after a price tick, and seconds to pause between
+# transactions so writers sleeping in SQLite's busy handler get the lock instead of waiting out the whole refresh
+SNAPSHOT_CHUNK_SIZE = 500
+SNAPSHOT_CHUNK_PAUSE = 0.01
+
+logger = logging.getLogger("mockstock.performance")
+
+
+def today():
+    """Return today's UTC date in ISO format, matching SQLite's date('now')."""
+    return datetime.now(timezone.utc).date().isoformat()
+
+
+def record_prices(conn, prices, user_ids):
+    """Store {symbol: price_cents} as today's prices and refresh today's snapshot for user_ids.
+
+    Runs inside the caller's transaction.
+    """
+    day = today()
+    conn.executemany("""INSERT INTO prices (symbol, date, price_cents) VALUES (?,?,?)
+                        ON CONFLICT (symbol, date) DO UPDATE SET price_cents = excluded.price_cents""",
+                     [(symbol, day, price_cents) for symbol, price_cents in prices.items()])
+    if user_ids:
+        record_snapshots(conn, user_ids)
+
+
+def record_snapshots(conn, user_ids):
+    """Refresh today's snapshot for user_ids, e.g. after a deposit. Runs inside the caller's transaction."""
+    day = today()
+    conn.execute(SNAPSHOT_SQL.format(users=",".join("?" * len(user_ids))), [day, day] + list(user_ids))
+
+
+class PriceRecorder(threading.Thread):
+    """Daemon thread that records fresh quotes as price ticks, off the request that fetched them.
+
+    Quote listeners only record the latest price per symbol, so a burst of
+    updates collapses into one write of the newest prices. Holders' snapshots
+    are then refreshed SNAPSHOT_CHUNK_SIZE users per transaction, pausing
+    between transactions.
+    """
+
+    def __init__(self):
+        super().__init__(name="price-recorder", daemon=True)
+        self._pending = {}
+        self._changed = threading.Condition()
+
+    def on_quotes(self, quotes):
+        """Queue freshly fetched quotes for recording; registered as a helpers quote listener."""
+        with self._changed:
+            self._pending.update({symbol: round(quote["price"] * 100) for symbol, quote in quotes.items()})
+            self._changed.notify()
+
+    def record(self, conn, prices):
+        """Store prices as today's, then refresh today's snapshot for everyone holding one of the symbols."""
+        with db.transaction(conn):
+            record_prices(conn, prices, [])
+        holders = [row[0] for row in conn.execute(f"SELECT DISTINCT user_id FROM holdings WHERE symbol IN ({','.join('?' * len(prices))})",
+                                                  list(prices))]
+        for i in range(0, len(holders), SNAPSHOT_CHUNK_SIZE):
+            if i:
+                time.sleep(SNAPSHOT_CHUNK_PAUSE)
+            with db.transaction(conn):
+                record_snapshots(conn, holders[i:i + SNAPSHOT_CHUNK_SIZE])
+
+    def run(self):
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: self._pending)
+                prices, self._pending = self._pending, {}
+            try:
+                with db.connection() as conn:
+                    self.record(conn, prices)
+            except Exception:
+                logger.exception("recording prices failed")
+
+
+def first_missing_day(conn, user_id):
+    """Return the first day from user_id's first trade through today with no snapshot, or None if none is missing.
+
+    Snapshots written by trades and price ticks can leave days out, so every
+    day from the first trade on is checked, not just those after the latest row.
+    """
+    end = today()
+    first = conn.execute("SELECT MIN(date(timestamp)) FROM transactions WHERE user_id = ?",
+                         (user_id,)).fetchone()[0] or end
+    first = min(first, end)
+    have = {row[0] for row in conn.execute("SELECT date FROM portfolio_snapshots WHERE user_id = ? AND date BETWEEN ? AND ?",
+                                           (user_id, first, end))}
+    return next((day.date().isoformat() for day in pd.date_range(first, end, freq="D")
+                 if day.date().isoformat() not in have), None)
+
+
+def fill_snapshots(conn, user_id):
+    """Compute user_id's snapshots from the first missing day through today, if any day is missing."""
+    start = first_missing_day(conn, user_id)
+    if start is None:
+        return
+    snapshots = snapshot_frame(conn, user_id, start, today())
+    conn.executemany("""INSERT OR REPLACE INTO portfolio_snapshots (user_id, date, cash_cents, market_value_cents)
+                        VALUES (?,?,?,?)""",
+                     [(user_id, day.date().isoformat(), int(row.cash_cents), int(row.market_value_cents))
+                      for day, row in snapshots.iterrows()])
+
+
+def snapshot_frame(conn, user_id, start, end):
+    """Return end-of-day cash and market value for each day from start to end, indexed by date.
+
+    Balances are worked backwards from the user's current cash and holdings by
+    undoing the trades made after each day, so only trades since start are
+    read. Deposits aren't in the ledger, so they count as cash held from start.
+    """
+    days = pd.date_range(start, end, freq="D")
+    cash_now = conn.execute("SELECT cash_cents FROM users WHERE user_id = ?", (user_id,)).fetchone()[0]
+    holdings = pd.read_sql_query("SELECT symbol, shares FROM holdings WHERE user_id = ?", conn,
+                                 params=(user_id,), index_col="symbol")["shares"]
+    trades = pd.read_sql_query("""SELECT date(timestamp) AS date, symbol, shares, shares * price_cents AS spent
+                                  FROM transactions WHERE user_id = ? AND timestamp >= ?""", conn,
+                               params=(user_id, start), parse_dates=["date"])
+    symbols = sorted(set(holdings.index) | set(trades["symbol"]))
+
+    # Shares traded and cash spent per day, then the totals traded after each day
+    if trades.empty:
+        traded = pd.DataFrame(0.0, index=days, columns=symbols)
+    else:
+        traded = (trades.pivot_table(index="date", columns="symbol", values="shares", aggfunc="sum")
+                  .reindex(index=days, columns=symbols).fillna(0))
+    spent = trades.groupby("date")["spent"].sum().reindex(days).fillna(0)
+    traded_after = traded[::-1].cumsum()[::-1].shift(-1).fillna(0)
+    spent_after = spent[::-1].cumsum()[::-1].shift(-1).fillna(0)
+
+    # Undo later trades to get each day's closing positions and cash
+    positions = traded_after.rsub(holdings.reindex(symbols).fillna(0), axis="columns")
+    cash = cash_now + spent_after
+
+    market_value = (positions * price_frame(conn, symbols, start, end)).fillna(0).sum(axis=1)
+    return pd.DataFrame({"cash_cents": cash.round(), "market_value_cents": market_value.round()}, index=days)
+
+
+def price_frame(conn, symbols, start, end):
+    """Return each symbol's price on each day from start to end, carrying the last known price forward."""
+    days = pd.date_range(start, end, freq="D")
+    if not symbols:
+        return pd.DataFrame(index=days)
+    marks = ",".join("?" * len(symbols))
+    history = pd.read_sql_query(f"""SELECT symbol, date, price_cents FROM prices
+                                    WHERE symbol IN ({marks}) AND date BETWEEN ? AND ?
+                                    UNION ALL
+                                    SELECT symbol, MAX(date), price_cents FROM prices
+                                    WHERE symbol IN ({marks}) AND date < ? GROUP BY symbol""", conn,
+                                params=[*symbols, start, end, *symbols, start], parse_dates=["date"])
+
+    # Prices from before start seed the first day
+    history = history.sort_values("date")
+    history["date"] = history["date"].clip(lower=pd.Timestamp(start))
+    prices = history.pivot_table(index="date", columns="symbol", values="price_cents", aggfunc="last")
+    return prices.reindex(index=days, columns=symbols).ffill()
+
+
+def performance(conn, user_id):
+    """Return user_id's daily equity curve and per-symbol gains, filling any missing snapshots first.
+
+    Trades, deposits and price ticks keep today's snapshot current, so the write
+    lock is only taken when a day is missing, and the check is repeated under it.
+    """
+    if first_missing_day(conn, user_id) is not None:
+        with db.transaction(conn):
+            fill_snapshots(conn, user_id)
+
+    series = pd.read_sql_query("""SELECT date, cash_cents, market_value_cents FROM portfolio_snapshots
+                                  WHERE user_id = ? ORDER BY date""", conn, params=(user_id,))
+    series["equity_cents"] = series["cash_cents"] + series["market_value_cents"]
+    series["pnl_cents"] = series["equity_cents"].diff().fillna(0)
+
+    gains = pd.read_sql_query("""SELECT h.symbol, h.shares, h.cost_basis_cents,
+                                        (SELECT p.price_cents FROM prices p WHERE p.symbol = h.symbol
+                                         ORDER BY p.date DESC LIMIT 1) AS price_cents,
+                                        COALESCE(r.realized_cents, 0) AS realized_cents
+                                 FROM holdings h LEFT JOIN realized_gains r ON r.user_id = h.user_id AND r.symbol = h.symbol
+                                 WHERE h.user_id = ?
+                                 UNION ALL
+                                 SELECT r.symbol, 0, 0, NULL, r.realized_cents FROM realized_gains r
+                                 WHERE r.user_id = ? AND r.symbol NOT IN (SELECT symbol FROM holdings WHERE user_id = ?)
+                                 ORDER BY 1""", conn, params=(user_id, user_id, user_id))
+    # A column with no prices at all comes back as objects, which can't be rounded
+    gains["price_cents"] = pd.to_numeric(gains["price_cents"])
+    gains["market_value_cents"] = (gains["shares"] * gains["price_cents"]).round().fillna(gains["cost_basis_cents"])
+    gains["unrealized_cents"] = gains["market_value_cents"] - gains["cost_basis_cents"]
+
+    return {
+        "series": [
+            {"date": row.date, "cash": row.cash_cents / 100, "market_value": row.market_value_cents / 100,
+             "equity": row.equity_cents / 100, "pnl": row.pnl_cents / 100}
+            for row in series.itertuples()
+        ],
+        "gains": [
+            {"symbol": row.symbol, "shares": row.shares, "cost_basis": row.cost_basis_cents / 100,
+             "market_value": row.market_value_cents / 100, "unrealized": row.unrealized_cents / 100,
+             "realized": row.realized_cents / 100}
+            for row in gains.itertuples()
+        ],
+    }
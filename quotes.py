@@ -0,0 +1,277 @@
+import csv
+import math
+import os
+import random
+import requests
+import threading
+import time
+import urllib.parse
+import zlib
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# Upstream timeouts (seconds), retry policy and connection pool size
+QUOTE_CONNECT_TIMEOUT = float(os.environ.get("QUOTE_CONNECT_TIMEOUT", 2))
+QUOTE_READ_TIMEOUT = float(os.environ.get("QUOTE_READ_TIMEOUT", 5))
+QUOTE_RETRIES = int(os.environ.get("QUOTE_RETRIES", 2))
+QUOTE_BACKOFF = float(os.environ.get("QUOTE_BACKOFF", 0.2))
+QUOTE_POOL_SIZE = int(os.environ.get("QUOTE_POOL_SIZE", 16))
+
+
+class QuoteUnavailable(Exception):
+    """Raised when a provider can't be reached, as opposed to not knowing a symbol."""
+
+
+class CircuitBreaker:
+    """Stop calling a failing provider for a while after repeated failures.
+
+    After `threshold` consecutive failures the breaker opens and rejects calls
+    for `reset_timeout` seconds, then lets a single trial call through
+    (half-open); its success closes the breaker and its failure reopens it.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        """Return whether a call may go through now."""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self._trial = False
+
+
+class QuoteProvider:
+    """Interface every quote backend implements."""
+
+    # Whether quotes() fetches many symbols in one upstream call rather than one quote() per symbol
+    batched = False
+
+    def quote(self, symbol):
+        """Return {"name", "price", "symbol"} for symbol, or None if unknown."""
+        raise NotImplementedError
+
+    def quotes(self, symbols):
+        """Return quotes for symbols keyed by upper-case symbol, omitting unknown ones."""
+        quotes = {}
+        for symbol in symbols:
+            quote = self.quote(symbol)
+            if quote is not None:
+                quotes[symbol.upper()] = quote
+        return quotes
+
+
+class IEXProvider(QuoteProvider):
+    """Quotes from the IEX Cloud API over a persistent, connection-pooled session.
+
+    Requests time out after QUOTE_CONNECT_TIMEOUT/QUOTE_READ_TIMEOUT seconds and
+    are retried with exponential backoff on connection errors and 429/5xx
+    responses. When the API still can't be reached, QuoteUnavailable is raised.
+    """
+
+    batched = True
+
+    # Most symbols the batch endpoint accepts in one request
+    BATCH_SIZE = 100
+
+    def __init__(self, token, base_url="https://cloud.iexapis.com/stable"):
+        self.token = token
+        self.base_url = base_url
+        self.timeout = (QUOTE_CONNECT_TIMEOUT, QUOTE_READ_TIMEOUT)
+        retry = Retry(total=QUOTE_RETRIES, backoff_factor=QUOTE_BACKOFF,
+                      status_forcelist=(429, 500, 502, 503, 504), allowed_methods=("GET",))
+        adapter = HTTPAdapter(pool_connections=QUOTE_POOL_SIZE, pool_maxsize=QUOTE_POOL_SIZE, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _get(self, url):
+        """GET url, returning the response, None for an unknown symbol, or raising QuoteUnavailable."""
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise QuoteUnavailable(str(e)) from e
+        if response.status_code in (400, 404):
+            return None
+        if not response.ok:
+            raise QuoteUnavailable(f"HTTP {response.status_code}")
+        return response
+
+    def quote(self, symbol):
+
+        # Contact API
+        response = self._get(f"{self.base_url}/stock/{urllib.parse.quote_plus(symbol)}/quote?token={self.token}")
+        if response is None:
+            return None
+
+        # Parse response
+        try:
+            return self._parse(response.json())
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def quotes(self, symbols):
+        symbols = list(symbols)
+        quotes = {}
+        for i in range(0, len(symbols), self.BATCH_SIZE):
+            quotes.update(self._batch(symbols[i:i + self.BATCH_SIZE]))
+        return quotes
+
+    def _batch(self, symbols):
+        """Return quotes for at most BATCH_SIZE symbols from one batch request."""
+
+        # Contact API's batch endpoint
+        response = self._get(f"{self.base_url}/stock/market/batch?symbols={urllib.parse.quote_plus(','.join(symbols))}&types=quote&token={self.token}")
+        if response is None:
+            return {}
+
+        # Parse response
+        try:
+            return {symbol.upper(): self._parse(data["quote"]) for symbol, data in response.json().items()}
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return {}
+
+    @staticmethod
+    def _parse(quote):
+        return {
+            "name": quote["companyName"],
+            "price": float(quote["latestPrice"]),
+            "symbol": quote["symbol"]
+        }
+
+
+class SimulatedProvider(QuoteProvider):
+    """Deterministic random-walk prices that never touch the network.
+
+    Every symbol gets its own generator seeded from the provider seed and the
+    symbol, so a given seed always produces the same price path. The walk takes
+    one step every `interval` seconds (or on every call when interval is 0).
+    """
+
+    def __init__(self, seed=0, start_price=100.0, volatility=0.01, interval=1.0):
+        self.seed = seed
+        self.start_price = start_price
+        self.volatility = volatility
+        self.interval = interval
+        self._started = time.monotonic()
+        self._walks = {}
+        self._lock = threading.Lock()
+
+    def quote(self, symbol):
+        symbol = symbol.upper()
+
+        # Only plain ticker-like symbols exist
+        if not symbol.isalpha() or len(symbol) > 5:
+            return None
+
+        with self._lock:
+            walk = self._walks.get(symbol)
+            if walk is None:
+                rng = random.Random(self.seed ^ zlib.crc32(symbol.encode()))
+                walk = self._walks[symbol] = {"rng": rng, "step": 0, "price": self.start_price * rng.uniform(0.2, 5)}
+
+            # Advance the walk to the current step
+            if self.interval:
+                target = int((time.monotonic() - self._started) / self.interval)
+            else:
+                target = walk["step"] + 1
+            while walk["step"] < target:
+                walk["price"] *= math.exp(walk["rng"].gauss(0, self.volatility))
+                walk["step"] += 1
+            price = round(walk["price"], 2)
+
+        return {"name": f"{symbol} Inc.", "price": price, "symbol": symbol}
+
+
+class ReplayProvider(QuoteProvider):
+    """Replay recorded prices from a CSV or Parquet tick file.
+
+    The file needs `symbol` and `price` columns, and may have `name`. Ticks are
+    replayed in file order, each symbol advancing to its next tick every
+    `interval` seconds (or on every call when interval is 0) and wrapping
+    around at the end.
+    """
+
+    def __init__(self, path, interval=1.0):
+        self.interval = interval
+        self._ticks = {}
+        self._names = {}
+        self._calls = {}
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+        for row in self._read(path):
+            symbol = row["symbol"].upper()
+            self._ticks.setdefault(symbol, []).append(float(row["price"]))
+            if row.get("name"):
+                self._names[symbol] = row["name"]
+
+    @staticmethod
+    def _read(path):
+        if path.endswith(".parquet"):
+            import pandas
+            return pandas.read_parquet(path).to_dict("records")
+        with open(path, newline="") as file:
+            return list(csv.DictReader(file))
+
+    def quote(self, symbol):
+        symbol = symbol.upper()
+        ticks = self._ticks.get(symbol)
+        if not ticks:
+            return None
+
+        # Pick the tick for the current step
+        if self.interval:
+            step = int((time.monotonic() - self._started) / self.interval)
+        else:
+            with self._lock:
+                step = self._calls.get(symbol, 0)
+                self._calls[symbol] = step + 1
+        price = ticks[step % len(ticks)]
+
+        return {"name": self._names.get(symbol, symbol), "price": price, "symbol": symbol}
+
+
+def get_provider():
+    """Build the quote provider selected by the QUOTE_PROVIDER environment variable."""
+    name = os.environ.get("QUOTE_PROVIDER", "iex")
+    if name == "iex":
+        return IEXProvider(os.environ.get("IEX_TOKEN", "pk_7e83c823d9f24d0e993c6d16659290ca"))
+    if name == "simulated":
+        return SimulatedProvider(seed=int(os.environ.get("QUOTE_SEED", 0)),
+                                 interval=float(os.environ.get("QUOTE_INTERVAL", 1)))
+    if name == "replay":
+        return ReplayProvider(os.environ["QUOTE_REPLAY_FILE"],
+                              interval=float(os.environ.get("QUOTE_INTERVAL", 1)))
+    raise ValueError(f"unknown QUOTE_PROVIDER {name!r}")
@@ -0,0 +1,106 @@
+import asyncio
+import os
+import threading
+import time
+
+import db
+import helpers
+
+
+# Symbols read from the quotes table per query
+STORE_CHUNK_SIZE = 500
+
+# Seconds between background refreshes of every held or ordered symbol; 0 disables the refresher
+QUOTE_REFRESH_INTERVAL = float(os.environ.get("QUOTE_REFRESH_INTERVAL", 15))
+
+
+class QuoteStore:
+    """Latest quotes in the quotes table, shared by every worker process."""
+
+    def get_many(self, symbols, max_age):
+        """Return {symbol: (quote, age in seconds)} for stored quotes no older than max_age."""
+        now = time.time()
+        symbols = list(symbols)
+        rows = []
+        with db.connection() as conn:
+            for i in range(0, len(symbols), STORE_CHUNK_SIZE):
+                chunk = symbols[i:i + STORE_CHUNK_SIZE]
+                marks = ",".join("?" * len(chunk))
+                rows += conn.execute(f"SELECT symbol, name, price_cents, updated_at FROM quotes WHERE symbol IN ({marks}) AND updated_at >= ?",
+                                     [*chunk, now - max_age]).fetchall()
+        return {symbol: ({"name": name, "price": price_cents / 100, "symbol": symbol}, now - updated_at)
+                for symbol, name, price_cents, updated_at in rows}
+
+    def put_many(self, quotes):
+        """Store {symbol: quote} as the latest quotes; registered as a helpers quote listener."""
+        now = time.time()
+        with db.connection() as conn:
+            with db.transaction(conn):
+                conn.executemany("""INSERT INTO quotes (symbol, name, price_cents, updated_at) VALUES (?,?,?,?)
+                                    ON CONFLICT (symbol) DO UPDATE
+                                    SET name = excluded.name, price_cents = excluded.price_cents, updated_at = excluded.updated_at""",
+                                 [(symbol, quote["name"], round(quote["price"] * 100), now) for symbol, quote in quotes.items()])
+
+
+class QuoteFeed:
+    """Latest quotes seen by this process, which subscribers can wait on for changes."""
+
+    def __init__(self):
+        self.version = 0
+        self.latest = {}
+        self._changed = threading.Condition()
+
+    def publish(self, quotes):
+        """Record {symbol: quote} and wake every waiting subscriber."""
+        with self._changed:
+            self.latest.update(quotes)
+            self.version += 1
+            self._changed.notify_all()
+
+    def wait(self, version, timeout):
+        """Block until the feed moves past version or timeout passes; return (version, latest quotes)."""
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version, timeout)
+            return self.version, dict(self.latest)
+
+
+class QuoteRefresher(threading.Thread):
+    """Daemon thread that keeps quotes for every held symbol, and every symbol with open orders, warm.
+
+    Each pass fetches only the symbols whose shared quote is older than the
+    interval, so several worker processes refreshing together still make about
+    one upstream batch per interval between them.
+    """
+
+    def __init__(self, feed, interval=QUOTE_REFRESH_INTERVAL):
+        super().__init__(name="quote-refresher", daemon=True)
+        self.feed = feed
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            started = time.monotonic()
+            try:
+                self.refresh()
+            except Exception:
+                helpers.quote_errors.inc(reason="refresh")
+            self._stopped.wait(max(0, self.interval - (time.monotonic() - started)))
+
+    def refresh(self):
+        """Refresh quotes for every symbol held by any user or named by an open order, and publish them to the feed."""
+        with db.connection() as conn:
+            symbols = [row[0] for row in conn.execute("""SELECT symbol FROM holdings
+                                                         UNION SELECT symbol FROM orders WHERE status = 'open'""")]
+        if not symbols:
+            return
+
+        # Without a batch call, fetch each symbol concurrently rather than one after another
+        if helpers.provider.batched:
+            quotes = helpers.lookup_many(symbols, max_age=self.interval)
+        else:
+            quotes = asyncio.run(helpers.lookup_many_async(symbols, max_age=self.interval))
+        self.feed.publish({symbol: quote for symbol, quote in quotes.items() if quote is not None})
+
+    def stop(self):
+        self._stopped.set()
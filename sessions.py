@@ -0,0 +1,121 @@
+import os
+import secrets
+import threading
+import time
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+import db
+
+
+# Where sessions live: "sqlite", "cookie", or any Flask-Session type such as "redis" or "filesystem"
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "sqlite")
+
+# Seconds between sweeps of expired sessions from the sessions table
+SESSION_SWEEP_INTERVAL = float(os.environ.get("SESSION_SWEEP_INTERVAL", 300))
+
+
+class SqliteSession(CallbackDict, SessionMixin):
+    """Session data stored server-side under a random session id."""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.opened_user_id = self.get("user_id")
+
+
+class SqliteSessionInterface(SessionInterface):
+    """Keep sessions in the sessions table, reading each with one primary-key lookup.
+
+    The cookie only holds a random session id. Rows expire after the app's
+    permanent_session_lifetime and are swept every SESSION_SWEEP_INTERVAL
+    seconds. A session gets a new id whenever its user_id changes, so an id
+    handed out before login never becomes an authenticated one. A session's expiry is only rewritten once half its lifetime has
+    passed, so unchanged sessions don't cost a write per request.
+    """
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, sweep_interval=SESSION_SWEEP_INTERVAL):
+        self.sweep_interval = sweep_interval
+        self._last_sweep = 0.0
+        self._lock = threading.Lock()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            with db.connection() as conn:
+                row = conn.execute("SELECT data, expires_at FROM sessions WHERE sid = ? AND expires_at > ?",
+                                   (sid, time.time())).fetchone()
+            if row is not None:
+                session = SqliteSession(self.serializer.loads(row[0]), sid=sid)
+                session.expires_at = row[1]
+                return session
+        return SqliteSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        now = time.time()
+        self._sweep(now)
+
+        # Forget an emptied session entirely
+        if not session:
+            if session.modified and not session.new:
+                with db.connection() as conn:
+                    conn.execute("DELETE FROM sessions WHERE sid = ?", (session.sid,))
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        # Write only changed sessions, or ones past half their lifetime
+        stale = now + lifetime / 2 > getattr(session, "expires_at", 0)
+        if not (session.modified or stale):
+            return
+        with db.connection() as conn:
+
+            # Replace the session id when the user logs in, out or as someone else
+            if session.get("user_id") != session.opened_user_id:
+                if not session.new:
+                    conn.execute("DELETE FROM sessions WHERE sid = ?", (session.sid,))
+                session.sid = secrets.token_urlsafe(32)
+            conn.execute("""INSERT INTO sessions (sid, data, expires_at) VALUES (?,?,?)
+                            ON CONFLICT (sid) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at""",
+                         (session.sid, self.serializer.dumps(dict(session)), now + lifetime))
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+    def _sweep(self, now):
+        """Delete expired sessions, at most once per sweep interval."""
+        with self._lock:
+            if now - self._last_sweep < self.sweep_interval:
+                return
+            self._last_sweep = now
+        with db.connection() as conn:
+            conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,))
+
+
+def init_app(app, backend=SESSION_BACKEND):
+    """Configure app to keep sessions in the chosen backend."""
+    if backend == "sqlite":
+        app.session_interface = SqliteSessionInterface()
+    elif backend == "cookie":
+
+        # Flask's built-in signed cookies, which need a SECRET_KEY shared by every worker
+        if not app.secret_key:
+            raise RuntimeError("SESSION_BACKEND=cookie needs SECRET_KEY to be set")
+    else:
+        from flask_session import Session
+        app.config["SESSION_TYPE"] = backend
+        if backend == "redis":
+            import redis
+            app.config["SESSION_REDIS"] = redis.from_url(os.environ.get("REDIS_URL", "redis://localhost:6379"))
+        Session(app)
@@ -0,0 +1,107 @@
+from db import transaction
+from performance import record_prices
+
+
+# Largest value a SQLite INTEGER column can hold
+SQLITE_MAX_INTEGER = 2 ** 63 - 1
+
+
+class TradeError(Exception):
+    """Raised when a trade can't be applied, with a message fit to show the user."""
+
+
+def execute_trade(conn, user_id, symbol, shares, price):
+    """Buy (positive shares) or sell (negative shares) symbol at price dollars in one transaction.
+
+    Returns the new transaction's id.
+    """
+    with transaction(conn):
+        return apply_trade(conn, user_id, symbol, shares, round(price * 100))
+
+
+def apply_trade(conn, user_id, symbol, shares, price_cents):
+    """Apply a trade's cash, position and ledger changes inside the caller's transaction.
+
+    Cash and share balances are checked by the same UPDATE that changes them,
+    so concurrent trades can't overdraw either one.
+    """
+    symbol = symbol.upper()
+
+    # Ensure the trade's value fits in the database; nobody holds that much cash or stock
+    amount = abs(shares) * price_cents
+    if not amount < SQLITE_MAX_INTEGER:
+        raise TradeError("not enough cash" if shares > 0 else "not enough stock")
+    value = round(amount)
+
+    if shares > 0:
+
+        # Pay for the shares if the user can afford them
+        cursor = conn.execute("UPDATE users SET cash_cents = cash_cents - ? WHERE user_id = ? AND cash_cents >= ?",
+                              (value, user_id, value))
+        if cursor.rowcount == 0:
+            raise TradeError("not enough cash")
+
+        # Add shares to the user's position
+        conn.execute("""INSERT INTO holdings (user_id, symbol, shares, cost_basis_cents) VALUES (?,?,?,?)
+                        ON CONFLICT (user_id, symbol) DO UPDATE
+                        SET shares = shares + excluded.shares, cost_basis_cents = cost_basis_cents + excluded.cost_basis_cents""",
+                     (user_id, symbol, shares, value))
+
+    elif shares < 0:
+
+        # Remove shares from the user's position at their average cost, if they hold enough
+        position = conn.execute("SELECT shares, cost_basis_cents FROM holdings WHERE user_id = ? AND symbol = ?",
+                                (user_id, symbol)).fetchone()
+        cursor = conn.execute("""UPDATE holdings SET cost_basis_cents = ROUND(cost_basis_cents * (shares - ?) / shares), shares = shares - ?
+                                 WHERE user_id = ? AND symbol = ? AND shares >= ?""",
+                              (-shares, -shares, user_id, symbol, -shares))
+        if cursor.rowcount == 0:
+            raise TradeError("not enough stock")
+        conn.execute("DELETE FROM holdings WHERE user_id = ? AND symbol = ? AND shares <= 0", (user_id, symbol))
+
+        # Book the gain over the cost of the shares sold
+        realized = value - round(position[1] * -shares / position[0])
+        conn.execute("""INSERT INTO realized_gains (user_id, symbol, realized_cents) VALUES (?,?,?)
+                        ON CONFLICT (user_id, symbol) DO UPDATE SET realized_cents = realized_cents + excluded.realized_cents""",
+                     (user_id, symbol, realized))
+
+        # Credit the sale
+        conn.execute("UPDATE users SET cash_cents = cash_cents + ? WHERE user_id = ?", (value, user_id))
+
+    else:
+        raise TradeError("number of shares invalid")
+
+    # Record the trade in the ledger
+    cursor = conn.execute("INSERT INTO transactions (user_id, symbol, shares, price_cents) VALUES (?,?,?,?)",
+                          (user_id, symbol, shares, price_cents))
+
+    # Bring today's price and portfolio snapshot up to date
+    record_prices(conn, {symbol: price_cents}, user_ids=[user_id])
+    return cursor.lastrowid
+
+
+def execute_basket(conn, user_id, orders, quotes):
+    """Apply a basket of orders in one transaction, returning a result per order in submitted order.
+
+    Each order is a dict with "symbol" and signed "shares", priced from quotes
+    (keyed by upper-case symbol). Sells run before buys so their proceeds can
+    fund the buys. An order that fails its checks is reported as rejected and
+    leaves no changes behind, while the rest of the basket still applies.
+    """
+    results = [None] * len(orders)
+    with transaction(conn):
+        for i in sorted(range(len(orders)), key=lambda i: orders[i]["shares"] > 0):
+            order = orders[i]
+            symbol = order["symbol"].upper()
+            result = {"symbol": symbol, "shares": order["shares"]}
+            quote = quotes.get(symbol)
+            try:
+                if not quote:
+                    raise TradeError("stock not found")
+                price_cents = round(quote["price"] * 100)
+                result["transaction_id"] = apply_trade(conn, user_id, symbol, order["shares"], price_cents)
+                result.update(status="filled", price=price_cents / 100)
+            except TradeError as e:
+                result.update(status="rejected", error=str(e))
+            results[i] = result
+    return results